@@ -2,6 +2,8 @@
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
 from collections import defaultdict
+import multiprocessing
+import multiprocessing.pool
 import os
 import subprocess
 import shutil
@@ -14,6 +16,8 @@ except ImportError:
 import time
 import tempfile
 
+from ..lib.utils import scan_pool
+
 import logging
 logger = logging.getLogger('archive_man')
 
@@ -147,11 +151,27 @@ class FTPArchiveHandler:
     off generation of the Sources and Releases files.
     """
 
-    def __init__(self, archiveroot, archs, suite, components=None, with_contents=False):
+    def __init__(self, archiveroot, archs, suite, components=None, with_contents=False,
+                 cachedir=None, workers=None, pool_files=None):
+        """
+        :param cachedir: persistent directory for the apt-ftparchive cache
+            databases.  If omitted, a temporary one is used and removed
+            after the run.
+        :param workers: how many apt-ftparchive processes may run at once,
+            defaults to the number of CPUs.
+        :param pool_files: paths of all files in the pool, if the caller
+            has already scanned it.
+        """
+        self.scanned_pool = pool_files
+        self.workers = workers or multiprocessing.cpu_count()
         self.tmpdir = tempfile.mkdtemp(prefix='apt')
         self.overrideroot = os.path.join(self.tmpdir, 'override')
         self.miscroot = os.path.join(self.tmpdir, 'misc')
-        self.cacheroot = os.path.join(self.tmpdir, 'cache')
+        self.persistent_cache = bool(cachedir)
+        if cachedir:
+            self.cacheroot = os.path.join(cachedir, 'ftparchive')
+        else:
+            self.cacheroot = os.path.join(self.tmpdir, 'cache')
 
         self.archiveroot = archiveroot
         self.distsroot = os.path.join(self.archiveroot, 'dists')
@@ -169,16 +189,16 @@ class FTPArchiveHandler:
         logger.debug("Generating file lists.")
         self.generateFileLists()
         logger.debug("Doing apt-ftparchive work.")
-        apt_config_filename = self.generateConfig()
+        apt_config_filenames = self.generateConfigs()
         self.generateDistTree()
-        self.runApt(apt_config_filename)
+        self.runApt(apt_config_filenames)
+        self.pruneCaches(apt_config_filenames)
         self.cleanCaches()
 
     def runAptWithArgs(self, apt_config_filename, *args):
-        """Run apt-ftparchive in subprocesses.
+        """Run apt-ftparchive in a subprocess.
 
-        :raise: AptFTPArchiveFailure if any of the apt-ftparchive
-            commands failed.
+        :raise: AptFTPArchiveFailure if the apt-ftparchive command failed.
         """
         logger.debug("Filepath: %s" % apt_config_filename)
 
@@ -188,11 +208,32 @@ class FTPArchiveHandler:
         if ret != 0:
             raise AptFTPArchiveFailure("apt-ftparchive failed")
 
-    def runApt(self, apt_config_filename):
-        if self.with_contents:
-            self.runAptWithArgs(apt_config_filename, "generate")
-        else:
-            self.runAptWithArgs(apt_config_filename, "--no-contents", "generate")
+    def runConfigs(self, func, apt_config_filenames):
+        """Run func for every configuration in a bounded pool of threads,
+        each of which waits for its own apt-ftparchive subprocess.
+
+        :raise: AptFTPArchiveFailure if any of the apt-ftparchive
+            commands failed.
+        """
+        workers = min(self.workers, len(apt_config_filenames))
+        if workers <= 1:
+            for apt_config_filename in apt_config_filenames:
+                func(apt_config_filename)
+            return
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            pool.map(func, apt_config_filenames, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def runApt(self, apt_config_filenames):
+        def generate(apt_config_filename):
+            if self.with_contents:
+                self.runAptWithArgs(apt_config_filename, "generate")
+            else:
+                self.runAptWithArgs(apt_config_filename, "--no-contents", "generate")
+        self.runConfigs(generate, apt_config_filenames)
 
     #
     # Empty Pocket Requests
@@ -204,7 +245,10 @@ class FTPArchiveHandler:
         anything in them currently.
         """
         make_clean_dir(self.miscroot)
-        make_clean_dir(self.cacheroot)
+        if not self.persistent_cache:
+            make_clean_dir(self.cacheroot)
+        elif not os.path.isdir(self.cacheroot):
+            os.makedirs(self.cacheroot)
         for comp in self.components:
             self.createEmptyPocketRequest(comp)
 
@@ -241,21 +285,22 @@ class FTPArchiveHandler:
     # File List Generation
     #
     def getPoolFiles(self):
-        for folder, _dirlist, filelist in os.walk(self.pool):
-            for filename in filelist:
-                filepath = os.path.join(folder, filename)
-                try:
-                    ext = filename.rsplit('.', 1)[1]
-                except:
-                    continue
-                subcomp = EXT_TO_SUBCOMPONENT.get(ext)
-                if subcomp != None:
-                    self.subcomponents.add(subcomp)
-                if ext.endswith('deb'):
-                    arch = os.path.splitext(filename)[0].split('_')[-1]
-                else:
-                    arch = 'source'
-                self.pool_files.append((filepath, arch, subcomp))
+        if self.scanned_pool is None:
+            self.scanned_pool = scan_pool(self.pool)
+        for filepath in sorted(self.scanned_pool):
+            filename = os.path.basename(filepath)
+            try:
+                ext = filename.rsplit('.', 1)[1]
+            except:
+                continue
+            subcomp = EXT_TO_SUBCOMPONENT.get(ext)
+            if subcomp != None:
+                self.subcomponents.add(subcomp)
+            if ext.endswith('deb'):
+                arch = os.path.splitext(filename)[0].split('_')[-1]
+            else:
+                arch = 'source'
+            self.pool_files.append((filepath, arch, subcomp))
 
     def generateFileLists(self):
         """Collect currently published FilePublishings and write filelists."""
@@ -325,27 +370,33 @@ class FTPArchiveHandler:
     #
     # Config Generation
     #
-    def generateConfig(self):
-        """Generate an APT FTPArchive configuration from the provided
-        config object and the paths we either know or have given to us.
-        """
-        apt_config = StringIO()
-        apt_config.write(CONFIG_HEADER % (self.archiveroot,
-                                          self.overrideroot,
-                                          self.cacheroot
-                                          ))
-
-        self.writeAptConfig(
-            apt_config,
-            ["", "gz"])
-
-        self.generateDistTree()
+    def generateConfigs(self):
+        """Generate one APT FTPArchive configuration per component, so
+        that they can run in parallel with their own cache databases.
 
-        apt_config_filename = os.path.join(self.miscroot, "apt.conf")
-        with open(apt_config_filename, "w") as fp:
-            fp.write(apt_config.getvalue())
-        apt_config.close()
-        return apt_config_filename
+        Contents-$(ARCH) covers every component of the suite, so when
+        Contents are wanted all components stay in one configuration.
+        """
+        if self.with_contents:
+            groups = [self.components]
+        else:
+            groups = [[component] for component in self.components]
+
+        apt_config_filenames = []
+        for components in groups:
+            apt_config = StringIO()
+            apt_config.write(CONFIG_HEADER % (self.archiveroot,
+                                              self.overrideroot,
+                                              self.cacheroot
+                                              ))
+            self.writeAptConfig(apt_config, ["", "gz"], components)
+            apt_config_filename = os.path.join(
+                self.miscroot, "apt-%s.conf" % "_".join(components))
+            with open(apt_config_filename, "w") as fp:
+                fp.write(apt_config.getvalue())
+            apt_config.close()
+            apt_config_filenames.append(apt_config_filename)
+        return apt_config_filenames
 
     def generateDistTree(self):
         # Make sure all the relevant directories exist and are empty.  Each
@@ -363,8 +414,8 @@ class FTPArchiveHandler:
                         component_path, subcomp, "binary-" + arch))
 
     def writeAptConfig(self, apt_config,
-                       index_compressors):
-        logger.debug("Generating apt config for %s" % self.suite)
+                       index_compressors, components):
+        logger.debug("Generating apt config for %s %s" % (self.suite, " ".join(components)))
         compressors = " ".join(
             COMPRESSOR_TO_CONFIG[c] for c in index_compressors)
         apt_config.write(STANZA_TEMPLATE % {
@@ -373,17 +424,17 @@ class FTPArchiveHandler:
                          "DISTRORELEASEBYFILE": self.suite,
                          "DISTRORELEASEONDISK": self.suite,
                          "ARCHITECTURES": " ".join(self.archs + ["source"]),
-                         "SECTIONS": " ".join(self.components),
+                         "SECTIONS": " ".join(components),
                          "EXTENSIONS": ".deb",
                          "COMPRESSORS": compressors,
-                         "CACHEINSERT": "",
+                         "CACHEINSERT": "-%s" % "-".join(components),
                          "DISTS": os.path.basename(self.distsroot),
                          "HIDEEXTRA": "",
                          "LONGDESCRIPTION": "true"
                          })
 
         if self.archs:
-            for component in self.components:
+            for component in components:
                 for subcomp in self.subcomponents:
                     apt_config.write(STANZA_TEMPLATE % {
                         "LISTPATH": self.overrideroot,
@@ -394,12 +445,28 @@ class FTPArchiveHandler:
                         "SECTIONS": subcomp,
                         "EXTENSIONS": '.%s' % SUBCOMPONENT_TO_EXT[subcomp],
                         "COMPRESSORS": compressors,
-                        "CACHEINSERT": "-%s" % subcomp,
+                        "CACHEINSERT": "-%s-%s" % (component, subcomp),
                         "DISTS": os.path.basename(self.distsroot),
                         "HIDEEXTRA": "// ",
                         "LONGDESCRIPTION": "true",
                     })
 
+    def pruneCaches(self, apt_config_filenames):
+        """Drop cache entries of files no longer in the pool.
+
+        Only done for persistent caches, at most once per CLEANUP_FREQUENCY.
+        """
+        if not self.persistent_cache:
+            return
+        stamp = os.path.join(self.cacheroot, 'last-clean')
+        if (os.path.exists(stamp) and
+                time.time() - os.path.getmtime(stamp) < CLEANUP_FREQUENCY):
+            return
+        logger.debug("Cleaning apt-ftparchive caches.")
+        self.runConfigs(lambda apt_config_filename: self.runAptWithArgs(apt_config_filename, "clean"),
+                        apt_config_filenames)
+        write_file(stamp, "")
+
     def cleanCaches(self):
         shutil.rmtree(self.tmpdir)
 
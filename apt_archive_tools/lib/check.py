@@ -10,20 +10,33 @@ Created on 2018-12-05
 
 cmd_doc = """
 检查dists索引里的软件包和pool中的deb文件列表是否一致，输出多余或缺失的deb包路径
-Usage: archive-man check <dir> [-s <suite>] [-m|--size]
+Usage: archive-man check <dir> [-s <suite>] [-m [--full]|--size] [-j <jobs>] [-r] [--shard=<i/N> --report=<file>]
+       archive-man check --combine <report>...
+       archive-man check <dir> --refs <path>...
 
 dir: 软件源目录，里面应该有dists和软件包目录（通常取名为pool）
 
 options:
    -s, --suite=<suite>         仅仅检查指定系列的索引中缺失的文件
-   -m, --md5                   检查仓库文件的md5是否与索引文件中一致
-                               不一致的以前缀 ! 输出
+   -m, --md5                   检查仓库文件的md5是否与索引文件中一致，索引中有sha256时
+                               同时检查sha256，不一致的以前缀 ! 输出
    --size                      检查size而不是md5，节省时间
+   --full                      不使用缓存的校验值，全部文件重新计算，默认只计算
+                               上次检查后有变化（inode、大小、修改时间）的文件
+   -j, --jobs=<jobs>           检查md5时同时读取的文件数，默认为配置的workers或CPU个数
+   -r, --resume                接着上次中断的检查继续，已经校验过的文件不再读取，
+                               仅对 --md5 有效
+   --shard=<i/N>               只检查第i个分片（i从1到N），pool中的文件按相对路径的散列值分为N片，
+                               多台机器可以分别检查同一个共享存储上的软件源
+   --report=<file>             同时把检查结果写入报告文件，检查完成后才会生成
+   --combine                   合并各个分片的报告，输出完整的检查结果
+   --refs                      列出引用这些文件的系列和索引文件，path为相对于dir的路径
    -h, --help                  show this help
 
 """
 
 import os
+import zlib
 from ..contrib import docopt
 from . import utils
 
@@ -32,7 +45,18 @@ import logging
 logger = logging.getLogger('archive_man')
 
 
-def check(topdir, suite=None, check_md5=False, check_size=False):
+def path_shard(relpath, count):
+    """
+    相对路径所属的分片（0到count-1），各台机器上的结果都一样
+    """
+    return (zlib.crc32(relpath.encode('utf-8')) & 0xffffffff) % count
+
+
+def check(topdir, suite=None, check_md5=False, check_size=False, jobs=None, full=False,
+          resume=False, shard=None, report=None):
+    """
+    shard 为 (i, N) 时只检查第i片，report 为报告文件路径
+    """
     index_dir = os.path.join(topdir, 'dists')
     if not os.path.isdir(index_dir):
         logger.error('%s 不是一个软件源目录', topdir)
@@ -56,105 +80,240 @@ def check(topdir, suite=None, check_md5=False, check_size=False):
             else:
                 continue
 
+    in_shard = None
+    if shard:
+        # 只统计、校验本分片的文件
+        index, count = shard
+
+        def in_shard(filepath):
+            return path_shard(os.path.relpath(filepath, topdir), count) == index - 1
+
+    def wanted(filepath):
+        return in_shard is None or in_shard(filepath)
+
     # all pool files
+    inventory = {}
     if not suite:
-        for folder, _, subfiles in os.walk(topdir):
-            if folder.startswith(index_dir):
-                continue
-            for subfile in subfiles:
-                filepath = os.path.join(folder, subfile)
+        # 其他分片的符号链接也会返回，用于找到本分片中的链接目标
+        inventory = utils.scan_pool(topdir, exclude=['dists'], with_size=check_size,
+                                    select=in_shard)
+        for filepath, poolfile in inventory.items():
+            if poolfile.link:
+                symlinks[filepath] = poolfile.link
+            if wanted(filepath):
                 pool_files.add(filepath)
-                if os.path.islink(filepath):
-                    symlinks[filepath] = os.path.realpath(filepath)
 
     hash_table = {}
+    sha256_table = {}
     size_table = {}
     keep_list = set()
     for filepath in P_files:
-        for package in utils.Packages.parse(filepath):
-            package_abs_path = os.path.join(topdir, package.filename)
+        for filename, md5sum, size, sha256 in utils.Packages.iter_latest(
+                filepath, lambda p: (p.filename, p.md5sum, p.size, p.sha256)):
+            package_abs_path = os.path.join(topdir, filename)
+            # 链接目标保留
+            target = symlinks.get(package_abs_path)
+            if target and wanted(target):
+                keep_list.add(target)
+            if not wanted(package_abs_path):
+                continue
             if check_md5:
                 # 检查不同索引文件中是否有同名文件不一致
                 old_md5sum = hash_table.get(package_abs_path)
-                if old_md5sum and package.md5sum != old_md5sum:
+                if old_md5sum and md5sum != old_md5sum:
                     logger.error('hash of %s differ in index files', package_abs_path)
-                hash_table[package_abs_path] = package.md5sum
+                hash_table[package_abs_path] = md5sum
+                if sha256:
+                    sha256_table[package_abs_path] = sha256
             if check_size:
                 # 检查不同索引文件中是否有同名文件不一致
                 old_size = size_table.get(package_abs_path)
-                if old_size and package.size != old_size:
+                if old_size and size != old_size:
                     logger.error('size of %s differ in index files', package_abs_path)
-                size_table[package_abs_path] = package.size
+                size_table[package_abs_path] = size
             keep_list.add(package_abs_path)
-            # 链接目标保留
-            try:
-                keep_list.add(symlinks[package_abs_path])
-            except:
-                pass
     for filepath in S_files:
-        for source in utils.Sources.parse(filepath):
-            for md5sum, size, filepath in source.fileinfos:
+        for fileinfos, sha256s in utils.Sources.iter_latest(
+                filepath, lambda s: (s.fileinfos, s.sha256s)):
+            for md5sum, size, filepath in fileinfos:
                 source_abs_path = os.path.join(topdir, filepath)
+                # 链接目标保留
+                target = symlinks.get(source_abs_path)
+                if target and wanted(target):
+                    keep_list.add(target)
+                if not wanted(source_abs_path):
+                    continue
+                size = int(size)
                 if check_md5:
                     old_md5sum = hash_table.get(source_abs_path)
                     if old_md5sum and md5sum != old_md5sum:
                         logger.error('hash of %s differ in index files', source_abs_path)
                     hash_table[source_abs_path] = md5sum
+                    if filepath in sha256s:
+                        sha256_table[source_abs_path] = sha256s[filepath]
                 if check_size:
                     old_size = size_table.get(source_abs_path)
                     if old_size and size != old_size:
                         logger.error('size of %s differ in index files', source_abs_path)
                     size_table[source_abs_path] = size
                 keep_list.add(source_abs_path)
-                # 链接目标保留
-                try:
-                    keep_list.add(symlinks[source_abs_path])
-                except:
-                    pass
 
     logger.info('Finished reading index')
 
+    report_file = None
+    if report:
+        report_file = open(report + '.tmp', 'w')
+        report_file.write('# shard %d/%d\n' % (shard or (1, 1)))
+
+    def output(mark, filepath):
+        print(mark, filepath)
+        if report_file:
+            report_file.write('%s %s\n' % (mark, filepath))
+
     if suite:
         for filepath in keep_list:
             if os.path.exists(filepath):
                 pool_files.add(filepath)
             else:
-                print('-', filepath)
+                output('-', filepath)
     else:
         # 对比
         for filepath in pool_files - keep_list:
-            print('+', filepath)
+            output('+', filepath)
 
         for filepath in keep_list - pool_files:
-            print('-', filepath)
+            output('-', filepath)
 
     if check_md5:
-        for filepath, md5sum in hash_table.items():
-            if not os.path.exists(filepath):
-                continue
-            if utils.file_hash(filepath) != md5sum:
-                print('!', filepath)
+        # 记录已校验的文件和结果，中断后可以继续
+        checkpoint = utils.Checkpoint('check', [topdir, suite, check_size,
+                                                 list(shard) if shard else None])
+        verified = set()
+        if resume:
+            for mark, filepath in checkpoint.load():
+                verified.add(filepath)
+                if mark:
+                    output(mark, filepath)
+        checkpoint.start(resume)
+        existing = [filepath for filepath in hash_table
+                    if filepath not in verified and os.path.exists(filepath)]
+        hash_names = ('md5', 'sha256') if sha256_table else ('md5',)
+        try:
+            for filepath, digests in utils.hash_files(existing, hash_names, threads=jobs,
+                                                      cache=utils.hash_cache, refresh=full):
+                sha256 = sha256_table.get(filepath)
+                mark = ''
+                if digests is None or digests['md5'] != hash_table[filepath] or \
+                        (sha256 and digests['sha256'] != sha256):
+                    mark = '!'
+                    output(mark, filepath)
+                checkpoint.add([mark, filepath])
+        finally:
+            checkpoint.close()
+        checkpoint.done()
 
     if check_size:
         for filepath, size in size_table.items():
-            if filepath not in set(pool_files):
+            if filepath not in pool_files:
                 continue
-            if os.stat(filepath).st_size != size:
-                print('!', filepath)
+            poolfile = inventory.get(filepath)
+            actual = poolfile.size if poolfile else os.stat(filepath).st_size
+            if actual != size:
+                output('!', filepath)
+
+    if report_file:
+        report_file.close()
+        os.rename(report + '.tmp', report)
 
     logger.info('检查完成')
     return True
 
 
+def combine(reports):
+    """
+    合并各个分片的报告，所有分片都齐全时按 + - ! 的顺序输出
+    """
+    results = {'+': set(), '-': set(), '!': set()}
+    shards = set()
+    total = None
+    for report in reports:
+        with open(report) as f:
+            header = f.readline().split()
+            if header[:2] != ['#', 'shard']:
+                logger.error('%s 不是检查报告', report)
+                return False
+            index, count = [int(n) for n in header[2].split('/')]
+            if total is not None and count != total:
+                logger.error('%s 的分片数 %d 与其他报告不一致', report, count)
+                return False
+            total = count
+            if index in shards:
+                logger.error('分片 %d/%d 重复', index, count)
+                return False
+            shards.add(index)
+            for line in f:
+                mark, filepath = line.rstrip('\n').split(' ', 1)
+                results[mark].add(filepath)
+    missing = set(range(1, (total or 0) + 1)) - shards
+    if missing:
+        logger.error('缺少分片: %s', ', '.join('%d/%d' % (i, total) for i in sorted(missing)))
+        return False
+    for mark in ('+', '-', '!'):
+        for filepath in sorted(results[mark]):
+            print(mark, filepath)
+    return True
+
+
+def show_refs(topdir, paths):
+    """
+    输出引用文件的系列和索引文件
+    """
+    refs = utils.ref_index(topdir)
+    if refs is None:
+        logger.error('没有配置cachedir，无法查询引用')
+        return False
+    refs.sync()
+    for path in paths:
+        if os.path.isabs(path):
+            path = os.path.relpath(path, topdir)
+        users = refs.users(path)
+        if not users:
+            print(path, '<unused>')
+        for suite, index_file in users:
+            print(path, suite, index_file)
+    refs.close()
+    return True
+
+
 def main(argv=None):
     """
     check missing or unnecessary debian packages in archive
     """
     args = docopt.docopt(cmd_doc, argv, help=True, version='1.0')
 
+    if args['--combine']:
+        return 0 if combine(args['<report>']) else 1
+
+    if args['--refs']:
+        return 0 if show_refs(os.path.abspath(args['<dir>']), args['<path>']) else 1
+
+    shard = None
+    if args['--shard']:
+        try:
+            shard = tuple(int(n) for n in args['--shard'].split('/'))
+            assert len(shard) == 2 and 1 <= shard[0] <= shard[1]
+        except (ValueError, AssertionError):
+            logger.error('分片的格式应为 i/N，1 <= i <= N')
+            return 1
+
     check(topdir=os.path.abspath(args['<dir>']),
           suite=args['--suite'],
           check_md5=args['--md5'],
-          check_size=args['--size']
+          check_size=args['--size'],
+          jobs=int(args['--jobs']) if args['--jobs'] else None,
+          full=args['--full'],
+          resume=args['--resume'],
+          shard=shard,
+          report=args['--report']
           )
     return 0
@@ -37,14 +37,20 @@ def checkdep(topdir, extra, ignore_noexist=False, ge_only=False):
     查找依赖未满足的包
     """
     pkg_in_archive = {}
+    # 需要检查依赖的包，只有 release 本身的，按索引文件分组
+    all_packages = []
     release = utils.Release.parse(os.path.join(topdir, 'Release'))
     extra_releases = [utils.Release.parse(
         os.path.join(extradir, 'Release')) for extradir in extra]
     # find all Packages
 
     for r in [release] + extra_releases:
-        for packages in r.all_packages.values():
-            for pkg in packages:
+        for _, fpath in r.index_files('Packages'):
+            packages = []
+            if r is release:
+                all_packages.append(packages)
+            for pkg in utils.Packages.iter_latest(fpath, checksum=r.index_checksum(fpath)):
+                packages.append(pkg)
                 # package
                 if pkg.name not in pkg_in_archive:
                     pkg_in_archive[pkg.name] = [pkg]
@@ -58,13 +64,13 @@ def checkdep(topdir, extra, ignore_noexist=False, ge_only=False):
                         pkg_in_archive[provide].append(pkg)
 
     # checkdep
-    for packages in release.all_packages.values():
+    for packages in all_packages:
         for pkg in packages:
             for dep_group in pkg.dependencies:
                 if not dep_group:
                     continue
 
-                if ignore_noexist and True not in [pkg_in_archive.has_key(p[0].split(':')[0]) for p in dep_group]:
+                if ignore_noexist and True not in [p[0].split(':')[0] in pkg_in_archive for p in dep_group]:
                     continue
 
                 if ge_only and '>=' not in [dep[1] for dep in dep_group]:
@@ -20,6 +20,9 @@ GPGHOME = os.path.expanduser(conf.get('app', 'gpghome'))
 GPGKEYPASS = conf.get('app', 'gpgpass')
 if not GPGKEYPASS:
     GPGKEYPASS = None
+CACHEDIR = os.path.expanduser(conf.get('app', 'cachedir'))
+WORKERS = conf.getint('app', 'workers')
+WORKER_TYPE = conf.get('app', 'worker_type')
 
 options = {'suite': conf.get('options', 'suite'),
            'arch': conf.get('options', 'arch')
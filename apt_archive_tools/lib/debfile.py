@@ -0,0 +1,318 @@
+# encoding: utf-8
+'''
+Created on 2026-10-17
+
+直接读取deb文件（ar归档）中的control和文件列表，生成Packages中的记录，
+不依赖apt-ftparchive、dpkg-deb
+
+'''
+
+import io
+import os
+import re
+import sqlite3
+import subprocess
+import tarfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import utils
+from . import logging
+
+logger = logging.getLogger('archive_man')
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+# Packages中由索引程序填写的字段，写在Description之前
+INDEX_FIELDS = ['Filename', 'Size', 'MD5sum', 'SHA1', 'SHA256']
+control_field_pattern = re.compile(r'^([^\s:]+):', re.M)
+
+
+class DebError(Exception):
+    """deb文件格式错误或无法解压"""
+
+
+class _LimitedReader(object):
+    """
+    只读取文件中从当前位置开始的size个字节
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remain = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remain:
+            size = self.remain
+        data = self.f.read(size)
+        self.remain -= len(data)
+        return data
+
+
+class _DecompressReader(object):
+    """
+    边读边解压，提供给tarfile流式读取
+    """
+
+    def __init__(self, f, decompressor):
+        self.f = f
+        self.decompressor = decompressor
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+            data = self.f.read(utils.HTTP_CHUNK_SIZE)
+            if data:
+                try:
+                    data = self.decompressor.decompress(data)
+                except Exception as e:
+                    # 各种解压器的异常类型不同：zlib.error、LZMAError、ZstdError等
+                    raise DebError('decompress failed: %s' % e)
+                self.buffer = self.buffer[self.pos:] + data
+                self.pos = 0
+            else:
+                self.eof = True
+        end = len(self.buffer) if size < 0 else self.pos + size
+        data = self.buffer[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class _Identity(object):
+    """不压缩的成员"""
+
+    def decompress(self, data):
+        return data
+
+
+class _ZstdProcessReader(object):
+    """
+    没有zstandard模块时，用zstd命令解压
+    """
+
+    def __init__(self, f):
+        try:
+            self.proc = subprocess.Popen(['zstd', '-dcq'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        except OSError:
+            raise DebError('zstd compressed member needs zstandard module or zstd command')
+        self.feeder = threading.Thread(target=self._feed, args=(f,))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self, f):
+        try:
+            while True:
+                data = f.read(utils.CHUNK_SIZE)
+                if not data:
+                    break
+                self.proc.stdin.write(data)
+        except (IOError, OSError):
+            # 读取方提前结束
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        self.feeder.join()
+        self.proc.wait()
+
+
+def iter_members(f):
+    """
+    遍历ar归档中的成员，返回 (成员名, 大小)，文件位置停在成员数据的开头
+    读取方不需要读完成员数据
+    """
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebError('not an ar archive')
+    offset = len(AR_MAGIC)
+    while True:
+        f.seek(offset)
+        header = f.read(AR_HEADER_SIZE)
+        if not header:
+            break
+        if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+            raise DebError('bad ar member header')
+        try:
+            name = header[:16].decode('ascii').strip().rstrip('/')
+            size = int(header[48:58])
+        except ValueError:
+            raise DebError('bad ar member header')
+        offset += AR_HEADER_SIZE + size + size % 2
+        yield name, size
+
+
+def open_member(f, name, size):
+    """
+    解压后的tar成员数据，name为control.tar.xz一类的成员名
+    """
+    reader = _LimitedReader(f, size)
+    ext = os.path.splitext(name)[1]
+    if ext == '.tar':
+        return _DecompressReader(reader, _Identity())
+    if ext == '.zst':
+        if zstandard is not None:
+            return _DecompressReader(reader, zstandard.ZstdDecompressor().decompressobj())
+        return _ZstdProcessReader(reader)
+    if ext not in utils.COMPRESSIONS:
+        raise DebError('unsupported compression: %s' % name)
+    return _DecompressReader(reader, utils.COMPRESSIONS[ext][1]())
+
+
+def read_deb(filepath, with_contents=False):
+    """
+    读取deb的control内容，with_contents为真时同时返回包内的文件列表
+    返回 (control, [文件路径, ...] 或 None)
+    """
+    control = None
+    contents = None
+    with open(filepath, 'rb') as f:
+        for name, size in iter_members(f):
+            if name.startswith('control.tar'):
+                stream = open_member(f, name, size)
+                try:
+                    data = stream.read()
+                finally:
+                    stream.close()
+                tar = tarfile.open(fileobj=io.BytesIO(data), mode='r:')
+                for member in tar:
+                    if member.name in ('./control', 'control'):
+                        try:
+                            control = tar.extractfile(member).read().decode('utf-8')
+                        except UnicodeDecodeError:
+                            raise DebError('control file of %s is not utf-8' % filepath)
+                        break
+            elif name.startswith('data.tar') and with_contents:
+                stream = open_member(f, name, size)
+                try:
+                    tar = tarfile.open(fileobj=stream, mode='r|')
+                    contents = [member.name[2:] if member.name.startswith('./')
+                                else member.name.lstrip('/')
+                                for member in tar if not member.isdir()]
+                finally:
+                    stream.close()
+            if control is not None and (contents is not None or not with_contents):
+                break
+    if control is None:
+        raise DebError('control file not found in %s' % filepath)
+    return control, contents
+
+
+def package_stanza(control, fileinfo):
+    """
+    在control内容中加入Filename、Size及校验值，生成Packages中的记录
+    fileinfo 为 {'Filename': .., 'Size': .., 'MD5sum': .., ...}
+    """
+    control = control.strip('\n')
+    index_text = '\n'.join('%s: %s' % (k, fileinfo[k]) for k in INDEX_FIELDS)
+    # 去掉control里可能带有的同名字段
+    lines = []
+    skip = False
+    for line in control.split('\n'):
+        match = control_field_pattern.match(line)
+        if match:
+            skip = match.group(1) in INDEX_FIELDS
+        if not skip:
+            lines.append(line)
+    control = '\n'.join(lines)
+    match = re.search(r'^Description:', control, re.M)
+    if match:
+        return control[:match.start()] + index_text + '\n' + control[match.start():]
+    return control + '\n' + index_text
+
+
+def index_deb(args):
+    """
+    读取一个deb，返回 (Packages记录, 文件列表或None)，deb损坏无法读取时返回None
+    可以在进程池中执行
+    """
+    filepath, filename, with_contents = args
+    try:
+        control, contents = read_deb(filepath, with_contents)
+        hashes = utils.file_hashes(filepath)
+    except (DebError, tarfile.TarError, IOError, OSError) as e:
+        logger.error('Unable to read %s, skipped: %s', filepath, e)
+        return None
+    stanza = package_stanza(control, {
+        'Filename': filename,
+        'Size': os.path.getsize(filepath),
+        'MD5sum': hashes['md5'],
+        'SHA1': hashes['sha1'],
+        'SHA256': hashes['sha256'],
+    })
+    return stanza, contents
+
+
+class DebCache(object):
+    """
+    deb读取结果的持久缓存，以pool中的相对路径为键，文件大小、修改时间、inode都不变时有效
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        if not os.path.isdir(os.path.dirname(dbfile)):
+            os.makedirs(os.path.dirname(dbfile))
+        self.db = sqlite3.connect(dbfile)
+        cu = self.db.cursor()
+        cu.execute('create table if not exists deb (path text primary key, '
+                   'size integer, mtime real, ino integer, stanza text, contents text)')
+        self.db.commit()
+
+    @staticmethod
+    def _key(st):
+        return st.st_size, st.st_mtime, st.st_ino
+
+    def get(self, path, st, with_contents=False):
+        """
+        返回 (Packages记录, 文件列表或None)，没有缓存时返回None
+        """
+        row = self.db.execute('select size, mtime, ino, stanza, contents from deb where path=?',
+                              (path,)).fetchone()
+        if not row or tuple(row[:3]) != self._key(st):
+            return None
+        if with_contents and row[4] is None:
+            return None
+        contents = row[4]
+        if contents is not None:
+            contents = contents.split('\n') if contents else []
+        return row[3], contents
+
+    def put(self, path, st, result):
+        stanza, contents = result
+        if contents is not None:
+            contents = '\n'.join(contents)
+        self.db.execute('insert or replace into deb values (?, ?, ?, ?, ?, ?)',
+                        (path,) + self._key(st) + (stanza, contents))
+
+    def prune(self, paths):
+        """
+        删除已经不在pool中的文件的缓存
+        """
+        paths = set(paths)
+        stale = [(path,) for path, in self.db.execute('select path from deb')
+                 if path not in paths]
+        self.db.executemany('delete from deb where path=?', stale)
+        return len(stale)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
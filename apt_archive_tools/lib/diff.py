@@ -48,12 +48,14 @@ def diff(dist1, dist2, method='source', listfile=False, compare=False):
     for vs, r in (versions1, release1), (versions2, release2):
         # 同一个系列中先确定最高版本
         if method == 'source':
-            all_packages = r.all_sources.values()
+            index_files = r.index_files('Sources')
+            index_class = utils.Sources
         else:
-            all_packages = r.all_packages.values()
+            index_files = r.index_files('Packages')
+            index_class = utils.Packages
 
-        for packages in all_packages:
-            for pkg in packages:
+        for _, fpath in index_files:
+            for pkg in index_class.iter_stanzas(fpath, r.index_checksum(fpath)):
                 pkgname = pkg.name + ', ' + pkg.arch
                 old_version = vs.get(pkgname, '')
                 if pkg <= old_version:
@@ -105,8 +107,10 @@ def diff_md5(archive1, archive2):
             return 1
         for release_file in glob.glob(os.path.join(index_dir, '*', 'Release')):
             release = utils.Release.parse(release_file)
-            for packages in release.all_packages.values() + release.all_sources.values():
-                for package in packages:
+            index_files = [(fpath, utils.Packages) for _, fpath in release.index_files('Packages')] + \
+                [(fpath, utils.Sources) for _, fpath in release.index_files('Sources')]
+            for fpath, index_class in index_files:
+                for package in index_class.iter_stanzas(fpath, release.index_checksum(fpath)):
                     if isinstance(package, utils.Source):
                         for md5, _size, filepath in package.fileinfos:
                             hash_table[filepath] = md5
@@ -0,0 +1,274 @@
+# encoding: utf-8
+'''
+Created on 2026-10-17
+
+在进程内批量移动pool中的文件：同一文件系统内直接rename，跨文件系统时复制后删除源文件。
+移动前把计划写入日志，中断后可以回滚或者继续完成
+
+'''
+
+import errno
+import json
+import multiprocessing.pool
+import os
+import shutil
+import threading
+
+from . import utils
+from . import logging
+
+logger = logging.getLogger('archive_man')
+
+# NFS上单个文件操作的延迟较高，用多个线程同时移动
+MOVE_THREADS = 8
+# 跨文件系统复制时每次调用复制的字节数
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+JOURNAL_NAME = '.move-journal'
+# 只复制、不删除源文件的记录标记
+COPY = 'copy'
+
+
+def _copy_data(fsrc, fdst, size):
+    """
+    用copy_file_range或sendfile在内核中复制数据，都不支持时退回到普通的读写。
+    复制的字节数与size不一致时抛出IOError，调用方不能删除源文件
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    for func in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, func):
+            continue
+        try:
+            while copied < size:
+                if func == 'copy_file_range':
+                    n = os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+                else:
+                    n = os.sendfile(outfd, infd, copied, COPY_CHUNK_SIZE)
+                if not n:
+                    break
+                copied += n
+            if copied == size:
+                return
+            if copied:
+                raise IOError(errno.EIO, 'short copy: %d of %d bytes' % (copied, size))
+            # 一个字节也没有复制（有的文件系统上直接返回0），换下一种方式
+        except OSError as e:
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                         errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    shutil.copyfileobj(fsrc, fdst, utils.CHUNK_SIZE)
+    fdst.flush()
+    copied = os.fstat(outfd).st_size
+    if copied != size:
+        raise IOError(errno.EIO, 'short copy: %d of %d bytes' % (copied, size))
+
+
+def copy_file(src, dst):
+    """
+    复制文件内容和属性，先写到临时文件，写完后再改名，dst不会出现不完整的文件
+    """
+    tmp = dst + '.part'
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            _copy_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+    shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+
+
+def move_file(src, dst):
+    """
+    移动一个文件，目标目录必须已经存在
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst + '.part')
+            os.rename(dst + '.part', dst)
+        else:
+            copy_file(src, dst)
+        os.unlink(src)
+
+
+def make_dirs(dirs):
+    """
+    一次创建所有需要的目录，每个目录只检查一次
+    """
+    for dirname in sorted(set(dirs)):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+
+class MoveJournal(object):
+    """
+    移动日志，第一行是计划移动的 [[源路径, 目标路径], ...]，之后每移动完一个文件追加一行源路径。
+    只复制不移动的记录是 [源路径, 目标路径, "copy"]
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.f = None
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.filepath)
+
+    def start(self, moves):
+        dirname = os.path.dirname(self.filepath)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # 行缓冲，进程被杀掉时已完成的记录不会丢失
+        self.f = open(self.filepath, 'w', 1)
+        self.f.write(json.dumps(moves) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def load(self):
+        """
+        返回 (计划移动的列表, 已完成的源路径集合)，并继续在日志后追加记录
+        """
+        moves = None
+        done = set()
+        with open(self.filepath) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 中断时写了一半的行
+                    break
+                if moves is None:
+                    moves = [tuple(move) for move in record]
+                else:
+                    done.add(record)
+        self.f = open(self.filepath, 'a', 1)
+        return moves or [], done
+
+    def add(self, src):
+        with self.lock:
+            self.f.write(json.dumps(src) + '\n')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        self.close()
+        os.remove(self.filepath)
+
+
+class PoolMover(object):
+    """
+    把pool中的文件批量移动到备份目录等位置，用法：
+        mover = PoolMover(journal_path)
+        mover.move([(src, dst), ...])
+    中断后用 complete() 继续完成，或者用 rollback() 把已移动的文件移回原处。
+    需要保留源文件时（如符号链接）用 (src, dst, COPY) 把内容复制到目标路径，回滚时删除目标
+    """
+
+    def __init__(self, journal_path, threads=None):
+        self.journal = MoveJournal(journal_path)
+        self.threads = threads or MOVE_THREADS
+
+    def pending(self):
+        """
+        是否有上次中断后没有处理的日志
+        """
+        return self.journal.exists()
+
+    def _run(self, func, moves):
+        if not moves:
+            return 0
+        failed = 0
+        pool = multiprocessing.pool.ThreadPool(max(1, min(self.threads, len(moves))))
+        try:
+            for ok in pool.imap_unordered(func, moves):
+                if not ok:
+                    failed += 1
+        finally:
+            pool.terminate()
+            pool.join()
+        return failed
+
+    def _move_one(self, move):
+        src, dst = move[:2]
+        try:
+            if move[2:] == (COPY,):
+                copy_file(src, dst)
+            else:
+                move_file(src, dst)
+        except (IOError, OSError) as e:
+            logger.error('move failed: %s -> %s: %s', src, dst, e)
+            return False
+        logger.debug('Moved: %s -> %s', src, dst)
+        self.journal.add(src)
+        return True
+
+    def _move_back(self, move):
+        src, dst = move[:2]
+        try:
+            if move[2:] == (COPY,):
+                os.remove(dst)
+            else:
+                move_file(dst, src)
+        except (IOError, OSError) as e:
+            logger.error('move back failed: %s -> %s: %s', dst, src, e)
+            return False
+        logger.debug('Moved back: %s -> %s', dst, src)
+        return True
+
+    def move(self, moves):
+        """
+        moves 为 [(源路径, 目标路径), ...]，返回移动失败的文件数，全部成功时删除日志
+        """
+        moves = [tuple(move) for move in moves]
+        self.journal.start(moves)
+        make_dirs(os.path.dirname(move[1]) for move in moves)
+        failed = self._run(self._move_one, moves)
+        if failed:
+            self.journal.close()
+            logger.error('%d files failed to move, journal kept: %s',
+                         failed, self.journal.filepath)
+        else:
+            self.journal.remove()
+        return failed
+
+    def complete(self):
+        """
+        继续移动上次没有移动完的文件
+        """
+        moves, done = self.journal.load()
+        todo = [move for move in moves
+                if move[0] not in done and os.path.lexists(move[0])]
+        logger.info('Completing %d of %d moves', len(todo), len(moves))
+        make_dirs(os.path.dirname(move[1]) for move in todo)
+        failed = self._run(self._move_one, todo)
+        if not failed:
+            self.journal.remove()
+        return failed
+
+    def rollback(self):
+        """
+        把上次已经移动的文件移回原处
+        """
+        moves, done = self.journal.load()
+        self.journal.close()
+        todo = []
+        for move in moves:
+            src, dst = move[:2]
+            if src in done:
+                if os.path.lexists(dst):
+                    todo.append(move)
+            elif os.path.lexists(dst + '.part'):
+                # 没有复制完的临时文件
+                os.remove(dst + '.part')
+        logger.info('Rolling back %d moves', len(todo))
+        make_dirs(os.path.dirname(move[0]) for move in todo)
+        failed = self._run(self._move_back, todo)
+        if not failed:
+            self.journal.remove()
+        return failed
@@ -0,0 +1,124 @@
+# coding:utf-8
+
+'''
+Created on 2026-10-17
+'''
+
+from __future__ import print_function
+
+cmd_doc = """
+把软件源中的文件移动到Debian标准的目录结构 pool/<component>/<prefix>/<source>/ 中，
+prefix是源码包名的首字母，lib开头的源码包为前4个字母（如libf）。
+同时修改所有引用这些文件的索引，并重新生成Release
+Usage: archive-man normalize <dir> [-d]
+
+dir: 软件源目录，里面应该有dists和软件包目录（通常取名为pool）
+
+options:
+   -d, --dry                   只输出需要移动的文件，并不执行
+   -h, --help                  show this help
+
+"""
+
+import os
+import glob
+import re
+from ..contrib import docopt
+from . import rename
+from . import utils
+
+import logging
+
+logger = logging.getLogger('archive_man')
+
+# 索引文件相对于系列目录的路径中的component，只取第一级目录，
+# 如 main/debian-installer/binary-amd64/Packages 的component是main
+component_pattern = re.compile(r'^([^/]+)/(?:.+/)?(binary-[^/]+|source)/')
+
+
+def pool_prefix(source):
+    """
+    源码包在pool中的分组目录名
+    """
+    if source.startswith('lib') and len(source) > 3:
+        return source[:4]
+    return source[0]
+
+
+def pool_dir(component, source):
+    return '/'.join(('pool', component, pool_prefix(source), source))
+
+
+def plan(topdir):
+    """
+    根据索引计算每个文件的标准路径，返回 {旧路径: 新路径}，只包含需要移动的文件。
+    同一个文件出现在多个component中时，以最先读到的为准
+    """
+    mapping = {}
+    for release_file in sorted(glob.glob(os.path.join(topdir, 'dists', '*', 'Release'))):
+        release = utils.Release.parse(release_file)
+        for name, index_class in (('Packages', utils.Packages), ('Sources', utils.Sources)):
+            for fn, fpath in release.index_files(name):
+                match = component_pattern.match(fn)
+                if not match:
+                    logger.warning('unknown component of %s, skipped', fpath)
+                    continue
+                component = match.group(1)
+                for package in index_class.iter_stanzas(fpath, release.index_checksum(fpath)):
+                    if isinstance(package, utils.Source):
+                        directory = pool_dir(component, package.name)
+                        file_list = package.files
+                    else:
+                        directory = pool_dir(component, package.source)
+                        file_list = [package.filename]
+                    for filename in file_list:
+                        new = directory + '/' + os.path.basename(filename)
+                        if new != filename:
+                            mapping.setdefault(filename, new)
+    return mapping
+
+
+def remove_empty_dirs(topdir, dirs):
+    """
+    删除移走文件后变空的目录，直到pool
+    """
+    for dirname in sorted(set(dirs), reverse=True):
+        path = os.path.join(topdir, dirname)
+        while dirname.count('/') > 0:
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            logger.debug('Removed empty directory: %s', path)
+            dirname = os.path.dirname(dirname)
+            path = os.path.dirname(path)
+
+
+def normalize(topdir, dryrun=False):
+    if not os.path.isdir(os.path.join(topdir, 'dists')):
+        logger.error('%s 不是一个软件源目录', topdir)
+        return 1
+
+    mapping = plan(topdir)
+    logger.info('%d files to move', len(mapping))
+    if dryrun:
+        for old, new in sorted(mapping.items()):
+            print(old, '->', new)
+        return 0
+    if not mapping:
+        return 0
+    result = rename.rename(topdir, rename.RenameRules(mapping), file=True)
+    if result == 0:
+        remove_empty_dirs(topdir, (os.path.dirname(old) for old in mapping))
+        logger.info('整理完成')
+    return result
+
+
+def main(argv=None):
+    """
+    move files into the standard pool/<component>/<prefix>/<source>/ layout
+    """
+    args = docopt.docopt(cmd_doc, argv, help=True, version='1.0')
+
+    return normalize(os.path.abspath(args['<dir>']),
+                     dryrun=args['--dry'])
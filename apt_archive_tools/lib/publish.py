@@ -10,16 +10,24 @@ Created on 2016-6-23
 
 from ..contrib import docopt
 import os
+import re
 import subprocess
 import logging
+from collections import defaultdict
+import hashlib
+import json
+import sqlite3
+from . import config
 from .config import options
 from ..contrib import ftparchive
+from . import debfile
+from . import utils
 
 logger = logging.getLogger('archive_man')
 
 cmd_doc = """
 Usage:
-   archive-man publish <topdir> [-s <suite>] [-v <version>] [-a <architecture>...] [-d <description>] [--contents]
+   archive-man publish <topdir> [-s <suite>] [-v <version>] [-a <architecture>...] [-d <description>] [--contents] [--cachedir=<dir>] [--incremental]
 
 Options:
    -h, --help              show this help.
@@ -33,6 +41,10 @@ Options:
    -d,--description=<description>
                            set description in Release.
    -c, --contents          generate Contents files
+   --cachedir=<dir>        keep package index caches of this archive in <dir>,
+                           default is a subdirectory of the configured cachedir.
+   -i, --incremental       only update index entries of files added, removed or
+                           changed in pool since the last publish of this suite.
 """ % options
 
 
@@ -46,6 +58,8 @@ def _verify_args(args):
     data['Description'] = args.get('--description', 'Customized archive.')
     data['topdir'] = os.path.abspath(os.path.expanduser(args['<topdir>']))
     data['content'] = args.get('--contents')
+    data['cachedir'] = args.get('--cachedir')
+    data['incremental'] = args.get('--incremental')
     return data
 
 
@@ -75,48 +89,375 @@ def gen_packages(topdir, suite, arch, component='main'):
     return ret == 0
 
 
-def apt_generate(topdir, suite, archs, components=['main'], with_contents=False):
+def classify(topdir, filepath, components):
+    """
+    pool中的文件属于哪个component，deb文件还返回arch和subcomponent
+    不在components中的顶层目录算作默认component，并加入components
+    返回 (component, arch, subcomponent)，dsc文件的arch为'source'
+    """
+    pool = os.path.join(topdir, 'pool')
+    topname = filepath[len(pool):].strip('/').split('/')[0]
+    if topname in components:
+        component = topname
+    else:
+        component = ftparchive.DEFAULT_COMPONENT
+        if component not in components:
+            components.append(component)
+    filename = os.path.basename(filepath)
+    ext = filename.rsplit('.', 1)[-1]
+    if ext == 'dsc':
+        return component, 'source', None
+    arch = os.path.splitext(filename)[0].split('_')[-1]
+    return component, arch, ftparchive.EXT_TO_SUBCOMPONENT.get(ext)
+
+
+def collect_packages(topdir, components, inventory=None):
+    """
+    pool中的所有deb和dsc，返回 [(路径, component, arch, subcomponent), ...]
+    inventory为utils.scan_pool扫描pool的结果，没有时重新扫描
+    """
+    if inventory is None:
+        inventory = utils.scan_pool(os.path.join(topdir, 'pool'))
+    files = []
+    for filepath in inventory:
+        ext = filepath.rsplit('.', 1)[-1]
+        if not ext.endswith('deb') and ext != 'dsc':
+            continue
+        files.append((filepath,) + classify(topdir, filepath, components))
+    files.sort(key=lambda f: (ftparchive.package_name(f[0]), f[0]))
+    return files
+
+
+def _targets(fileinfo, archs):
+    """
+    deb应该出现在哪些Packages中，返回 [(component, subcomponent, arch), ...]
+    """
+    _, component, arch, subcomp = fileinfo
+    return [(component, subcomp, target)
+            for target in (archs if arch == 'all' else [arch])
+            if target in archs]
+
+
+def _packages_file(topdir, suite, key):
+    component, subcomp, arch = key
+    return os.path.join(topdir, 'dists', suite, component,
+                        subcomp or '', 'binary-' + arch, 'Packages')
+
+
+def _sources_file(topdir, suite, component):
+    return os.path.join(topdir, 'dists', suite, component, 'source', 'Sources')
+
+
+def _index_order(relpath):
+    return ftparchive.package_name(relpath), relpath
+
+
+def index_debs(topdir, debs, with_contents=False, cachedir=None):
+    """
+    读取deb生成Packages记录，deb分散到进程池中读取
+    cachedir不为空时，大小、修改时间、inode都没变的deb直接使用上次的结果
+    返回与debs顺序一致的 [(Packages记录, 文件列表或None), ...]，无法读取的deb对应None
+    """
+    cache = debfile.DebCache(os.path.join(cachedir, 'debs.db')) if cachedir else None
+    tasks = []
+    results = [None] * len(debs)
+    for i, (filepath, _, _, subcomp) in enumerate(debs):
+        task = (filepath, os.path.relpath(filepath, topdir), with_contents and not subcomp)
+        if cache:
+            results[i] = cache.get(task[1], os.stat(filepath), task[2])
+        if results[i] is None:
+            tasks.append((i, task))
+    logger.info('indexing %d packages, %d cached', len(debs), len(debs) - len(tasks))
+    for (i, task), result in zip(tasks, utils.parallel_map(debfile.index_deb,
+                                                            [task for _, task in tasks],
+                                                            chunksize=64)):
+        results[i] = result
+        # 读取失败的不缓存，下次重新读取
+        if cache and result is not None:
+            cache.put(task[1], os.stat(task[0]), result)
+    if cache:
+        cache.close()
+    return results
+
+
+def gen_contents(topdir, suite, archs, debs, results):
+    """
+    根据deb中的文件列表生成各个架构的Contents
+    """
+    contents = defaultdict(lambda: utils.Contents(''))
+    for fileinfo, result in zip(debs, results):
+        if result is None or not result[1]:
+            continue
+        stanza, files = result
+        name = re.search(r'^Package: (.+)$', stanza, re.M).group(1)
+        section = re.search(r'^Section: (.+)$', stanza, re.M)
+        if section:
+            name = section.group(1) + '/' + name
+        for _, _, target in _targets(fileinfo, archs):
+            for path in files:
+                contents[target].files[path].add(name)
+    for arch in archs:
+        logger.info('generating Contents file for %s', arch)
+        contents[arch].write(os.path.join(topdir, 'dists', suite, 'Contents-' + arch))
+
+
+def gen_indexes(topdir, suite, archs, components, debs, with_contents=False,
+                cachedir=None):
+    """
+    直接读取pool中的deb生成所有的Packages（以及Contents）
+    返回无法读取的deb的相对路径
+    """
+    archs = [arch for arch in archs if arch not in ('src', 'source')]
+    results = index_debs(topdir, debs, with_contents, cachedir)
+    if cachedir:
+        cache = debfile.DebCache(os.path.join(cachedir, 'debs.db'))
+        pruned = cache.prune(os.path.relpath(deb[0], topdir) for deb in debs)
+        if pruned:
+            logger.debug('pruned %d cached packages', pruned)
+        cache.close()
+
+    packages = defaultdict(list)
+    subcomponents = set()
+    failed = []
+    for fileinfo, result in zip(debs, results):
+        if fileinfo[3]:
+            subcomponents.add(fileinfo[3])
+        if result is None:
+            failed.append(os.path.relpath(fileinfo[0], topdir))
+            continue
+        for key in _targets(fileinfo, archs):
+            packages[key].append(result[0])
+
+    # 没有包的架构也要生成空的Packages
+    for component in components:
+        for subcomp in [None] + sorted(subcomponents):
+            for arch in archs:
+                filepath = _packages_file(topdir, suite, (component, subcomp, arch))
+                if not os.path.isdir(os.path.dirname(filepath)):
+                    os.makedirs(os.path.dirname(filepath))
+                logger.debug('writing %s', filepath)
+                with utils.IndexWriter(filepath) as writer:
+                    for stanza in packages[(component, subcomp, arch)]:
+                        writer.write(stanza + '\n\n')
+    if with_contents:
+        gen_contents(topdir, suite, archs, debs, results)
+    return failed
+
+
+def gen_sources(topdir, suite, components, cachedir=None, inventory=None):
+    """
+    用apt-ftparchive生成components的Sources，全量和增量发布都用它生成，记录的格式一致
+    inventory为pool中需要处理的文件，没有时重新扫描
+    """
     publisher = ftparchive.FTPArchiveHandler(archiveroot=topdir,
-                                             archs=archs, suite=suite,
-                                             components=components,
-                                             with_contents=with_contents)
+                                             archs=[], suite=suite,
+                                             components=list(components),
+                                             cachedir=cachedir,
+                                             workers=config.WORKERS or None,
+                                             pool_files=inventory)
     publisher.run()
 
 
+def patch_indexes(topdir, suite, archs, components, pool_files, changed,
+                  with_contents=False, cachedir=None, inventory=None):
+    """
+    增量发布：只改写变化了的deb所在的Packages中的记录，有dsc变化的component重新生成Sources
+    changed为新增、删除或修改过的文件的相对路径，inventory为utils.scan_pool扫描pool的结果。
+    返回无法读取的deb的相对路径；需要改写的索引文件不存在时不做任何修改，返回None
+    """
+    archs = [arch for arch in archs if arch not in ('src', 'source')]
+    current = dict((os.path.relpath(f[0], topdir), f) for f in pool_files)
+    updated_debs = [current[path] for path in sorted(changed)
+                    if path in current and not path.endswith('.dsc')]
+
+    # Packages文件 -> {相对路径: 新的记录，删除时为None}
+    updates = defaultdict(dict)
+    # 需要重新生成Sources的component
+    source_components = set()
+    for path in changed:
+        fileinfo = current.get(path) or \
+            (os.path.join(topdir, path),) + classify(topdir, os.path.join(topdir, path),
+                                                     components)
+        if path.endswith('.dsc'):
+            source_components.add(fileinfo[1])
+        else:
+            for key in _targets(fileinfo, archs):
+                updates[_packages_file(topdir, suite, key)][path] = None
+
+    missing = [filepath for filepath in list(updates) +
+               [_sources_file(topdir, suite, component) for component in source_components]
+               if not os.path.exists(filepath)]
+    if missing:
+        logger.info('index file not found, need a full publish: %s', missing[0])
+        return None
+
+    results = index_debs(topdir, updated_debs, with_contents, cachedir)
+    failed = []
+    for fileinfo, result in zip(updated_debs, results):
+        path = os.path.relpath(fileinfo[0], topdir)
+        if result is None:
+            # 无法读取的deb从索引中去掉，下次发布时再读
+            failed.append(path)
+            continue
+        for key in _targets(fileinfo, archs):
+            updates[_packages_file(topdir, suite, key)][path] = result[0]
+
+    for filepath, changes in sorted(updates.items()):
+        logger.debug('patching %s', filepath)
+        # 马上就要改写，不需要缓存解析结果
+        stanzas = dict((package.filename, package.text)
+                       for package in utils.Packages.iter_stanzas(filepath, cache=False))
+        for path, stanza in changes.items():
+            if stanza is None:
+                stanzas.pop(path, None)
+            else:
+                stanzas[path] = stanza
+        with utils.IndexWriter(filepath) as writer:
+            for path in sorted(stanzas, key=_index_order):
+                writer.write(stanzas[path].strip('\n') + '\n\n')
+
+    if source_components:
+        logger.debug('regenerating Sources of %s', ', '.join(sorted(source_components)))
+        if inventory is None:
+            inventory = utils.scan_pool(os.path.join(topdir, 'pool'))
+        gen_sources(topdir, suite, sorted(source_components), cachedir,
+                    [filepath for filepath in inventory
+                     if classify(topdir, filepath, components)[0] in source_components])
+
+    if with_contents and any(not path.endswith('.dsc') for path in changed):
+        # Contents由所有deb的文件列表重新生成，没变的deb都在缓存中
+        debs = [f for f in pool_files if f[2] != 'source']
+        gen_contents(topdir, suite, archs, debs,
+                     index_debs(topdir, debs, with_contents, cachedir))
+    return failed
+
+
+def apt_generate(topdir, suite, archs, components=['main'], with_contents=False,
+                 cachedir=None, pool_files=None, inventory=None):
+    """
+    全量生成所有索引，返回无法读取的deb的相对路径
+    """
+    if inventory is None:
+        inventory = utils.scan_pool(os.path.join(topdir, 'pool'))
+    if pool_files is None:
+        pool_files = collect_packages(topdir, components, inventory)
+    # 二进制包的索引直接生成，apt-ftparchive只用来生成Sources
+    failed = gen_indexes(topdir, suite, archs, components,
+                         [f for f in pool_files if f[2] != 'source'],
+                         with_contents, cachedir)
+    gen_sources(topdir, suite, components, cachedir, inventory)
+    return failed
+
+
+class PoolManifest(object):
+    """
+    每个suite上次发布时的参数和pool中deb、dsc文件的 (大小, 修改时间, inode)，用于增量发布
+    """
+
+    def __init__(self, dbfile):
+        if not os.path.isdir(os.path.dirname(dbfile)):
+            os.makedirs(os.path.dirname(dbfile))
+        self.db = sqlite3.connect(dbfile)
+        cu = self.db.cursor()
+        cu.execute('create table if not exists publish (suite text primary key, params text)')
+        cu.execute('create table if not exists file (suite text, path text, '
+                   'size integer, mtime real, ino integer, primary key (suite, path))')
+        self.db.commit()
+
+    def load(self, suite, params):
+        """
+        上次发布时的 {相对路径: (大小, 修改时间, inode)}，没有发布过或者参数不同时返回None
+        """
+        row = self.db.execute('select params from publish where suite=?', (suite,)).fetchone()
+        if not row or json.loads(row[0]) != params:
+            return None
+        return dict((path, (size, mtime, ino)) for path, size, mtime, ino in
+                    self.db.execute('select path, size, mtime, ino from file where suite=?',
+                                    (suite,)))
+
+    def save(self, suite, params, files):
+        self.db.execute('delete from file where suite=?', (suite,))
+        self.db.executemany('insert into file values (?, ?, ?, ?, ?)',
+                            [(suite, path) + stat for path, stat in files.items()])
+        self.db.execute('insert or replace into publish values (?, ?)',
+                        (suite, json.dumps(params, sort_keys=True)))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def pool_stats(topdir, pool_files):
+    """
+    pool文件的 {相对路径: (大小, 修改时间, inode)}
+    """
+    stats = {}
+    for fileinfo in pool_files:
+        st = os.stat(fileinfo[0])
+        stats[os.path.relpath(fileinfo[0], topdir)] = (st.st_size, st.st_mtime, st.st_ino)
+    return stats
+
+
+def generate(topdir, suite, archs, components, with_contents=False, cachedir=None,
+             incremental=False):
+    """
+    生成所有索引文件，incremental为真时尽量只改写有变化的部分
+    """
+    if not cachedir:
+        if incremental:
+            logger.warning('incremental publish needs a cache directory, doing a full one')
+        apt_generate(topdir, suite, archs, components, with_contents)
+        return
+
+    inventory = utils.scan_pool(os.path.join(topdir, 'pool'))
+    pool_files = collect_packages(topdir, components, inventory)
+    stats = pool_stats(topdir, pool_files)
+    params = {'archs': sorted(archs), 'components': sorted(components),
+              'contents': bool(with_contents)}
+    manifest = PoolManifest(os.path.join(cachedir, 'manifest.db'))
+    previous = manifest.load(suite, params) if incremental else None
+    failed = None
+    if previous is not None:
+        changed = set(path for path in stats if previous.get(path) != stats[path]) | \
+            set(path for path in previous if path not in stats)
+        logger.info('%d files changed in pool', len(changed))
+        failed = patch_indexes(topdir, suite, archs, components, pool_files, changed,
+                               with_contents, cachedir, inventory)
+    if failed is None:
+        failed = apt_generate(topdir, suite, archs, components, with_contents, cachedir,
+                              pool_files, inventory)
+    # 无法读取的deb不记入清单，下次发布时当作新文件重新读取
+    for path in failed:
+        stats.pop(path, None)
+    manifest.save(suite, params, stats)
+    manifest.close()
+
+
+def publish_cachedir(topdir, cachedir=None):
+    """
+    每个软件源单独的缓存目录，未指定时放在配置的cachedir下，配置为空时不使用缓存
+    """
+    if cachedir:
+        return os.path.abspath(os.path.expanduser(cachedir))
+    if config.CACHEDIR:
+        return os.path.join(config.CACHEDIR, 'publish',
+                            hashlib.sha1(topdir.encode('utf-8')).hexdigest())
+    return None
+
+
 def gen_release(topdir, data):
     logger.info('generating Release file')
     data['Origin'] = 'apt-archive'
     data['Label'] = 'Apt Archive'
 
-    conf = """APT::FTPArchive::Release {
-Origin "%(Origin)s";
-Label "%(Label)s";
-Suite "%(Suite)s";
-Codename "%(Codename)s";
-Version "%(Version)s";
-Architectures "%(Architectures)s";
-Components "%(Components)s";
-Description "%(Description)s";
-};
-APT::FTPArchive::DoByHash yes;
-""" % data
-    # write conf
-    import tempfile
-    tmpconf = tempfile.mktemp('.conf')
-    with open(tmpconf, 'w') as f:
-        f.write(conf)
-    # generate Release
-    os.system(
-        'rm -f "%(top)s"/InRelease "%(top)s"/Release.gpg "%(top)s"/Release' % {'top': topdir})
-    content = os.popen('apt-ftparchive -c %(conf)s release %(top)s' % {'conf': tmpconf,
-                                                                       'top': topdir
-                                                                       }
-                       ).read()
-    with open(os.path.join(topdir, 'Release'), 'w') as f:
-        f.write(content)
+    from .utils import Release
+    release = Release(os.path.join(topdir, 'Release'))
+    for key in ['Origin', 'Label', 'Suite', 'Codename', 'Version',
+                'Architectures', 'Components', 'Description']:
+        release.data[key] = data[key]
+    # 同时会签名
+    release.write()
     logger.info('built Release in %s' % topdir)
-    from .sign import sign_file
-    sign_file(topdir)
 
 
 def publish_archive(data):
@@ -129,12 +470,23 @@ def publish_archive(data):
         os.makedirs(dists)
     # generate packages
     components = data['Components'].split()
-    apt_generate(topdir=data['topdir'],
+    cachedir = publish_cachedir(data['topdir'], data.get('cachedir'))
+    # 同一个软件源不能同时发布，缓存数据库也不能同时写
+    lock = utils.FileLock(os.path.join(cachedir, 'lock')) if cachedir else None
+    if lock:
+        lock.acquire()
+    try:
+        generate(topdir=data['topdir'],
                  suite=data['Suite'],
                  archs=data['Architectures'].split(),
                  components=components,
-                 with_contents=data['content']
+                 with_contents=data['content'],
+                 cachedir=cachedir,
+                 incremental=data['incremental']
                  )
+    finally:
+        if lock:
+            lock.release()
 
     # generate release
     gen_release(dists, data)
@@ -7,9 +7,10 @@ Created on 2019-01-22
 '''
 
 cmd_doc = """
-修改软件源索引中的软件包路径，注意：默认不会移动对应路径的文件；源码文件重命名的操作有点复杂，暂不支持。
-Usage: archive-man rename <dir> <origin> <new> [-f]
-       archive-man rename <dir> --list=<file> [-f]
+修改软件源索引（Packages和Sources）中的软件包路径，注意：默认不会移动对应路径的文件。
+所有索引只读写一遍，每个系列的Release只重新生成一次。
+Usage: archive-man rename <dir> <origin> <new> [-f] [-r]
+       archive-man rename <dir> --list=<file> [-f] [-r]
 
 dir:     软件源目录，里面应该有dists和软件包目录（通常取名为pool）
 origin:  需要修改的路径
@@ -21,79 +22,243 @@ options:
                                the file content like:
                                   origin1,new1
                                   origin2,new2
+   -r, --regex                 origin is a regular expression and new is the replacement,
+                               e.g. "^pool/main/(.)" "pool/main/\\1/\\1"
    -h, --help                  show this help
 
+源码包的所有文件改名后必须仍然在同一个目录中。
+
 """
 
 import os
 import glob
 import re
+import shutil
+import tempfile
+from collections import defaultdict
 from ..contrib import docopt
+from . import mover
 from . import utils
 
 import logging
 
 logger = logging.getLogger('archive_man')
 
+filename_pattern = re.compile(r'^Filename: (.+)$', re.M)
+directory_pattern = re.compile(r'^Directory: (.+)$', re.M)
+# Files、Checksums-*中的文件行
+file_line_pattern = re.compile(r'^( \w+\s+\d+ )(\S+)$', re.M)
+
+
+class RenameRules(object):
+    """
+    路径改名规则：先查精确的映射 {旧路径: 新路径}，再依次尝试正则表达式规则 [(pattern, 替换)]
+    调用时返回新路径，不需要改名时返回None
+    """
+
+    def __init__(self, mapping=None, patterns=None):
+        self.mapping = mapping or {}
+        self.patterns = [(re.compile(pattern), repl) for pattern, repl in patterns or []]
+
+    def __call__(self, path):
+        new = self.mapping.get(path)
+        if new is None:
+            for pattern, repl in self.patterns:
+                new, n = pattern.subn(repl, path, count=1)
+                if n:
+                    break
+            else:
+                return None
+        return new if new != path else None
+
+
+def rename_package(text, rules):
+    """
+    修改Packages记录中的Filename，返回 (新的记录, [(旧路径, 新路径)])，不需要修改时新的记录为None
+    """
+    match = filename_pattern.search(text)
+    if not match:
+        return None, []
+    old = match.group(1).strip()
+    new = rules(old)
+    if new is None:
+        return None, []
+    return text[:match.start(1)] + new + text[match.end(1):], [(old, new)]
+
+
+def rename_source(text, rules):
+    """
+    修改Sources记录中的Directory和文件名，返回值同 rename_package
+    """
+    match = directory_pattern.search(text)
+    if not match:
+        return None, []
+    directory = match.group(1).strip()
+    names = set(name for _, name in file_line_pattern.findall(text))
+    moves = []
+    new_names = {}
+    new_dirs = set()
+    for name in names:
+        old = directory + '/' + name
+        new = rules(old) or old
+        new_dir, new_names[name] = new.rsplit('/', 1) if '/' in new else ('', new)
+        new_dirs.add(new_dir)
+        if new != old:
+            moves.append((old, new))
+    if not moves:
+        return None, []
+    if len(new_dirs) != 1:
+        logger.error('files of source %s would be split into %s, skipped',
+                     directory, ', '.join(sorted(new_dirs)))
+        return None, []
+    new_dir = new_dirs.pop()
+    text = file_line_pattern.sub(lambda m: m.group(1) + new_names.get(m.group(2), m.group(2)),
+                                 text)
+    match = directory_pattern.search(text)
+    return text[:match.start(1)] + new_dir + text[match.end(1):], moves
+
+
+def _renamer(index_class):
+    return rename_source if index_class is utils.Sources else rename_package
+
+
+def _rename_index(args):
+    """
+    流式读取一个索引文件并修改其中的路径，修改后的内容先写到临时文件中，确认可以改名后再写回。
+    返回 (临时文件, [(旧路径, 新路径)])，没有需要修改的记录时临时文件为None
+    """
+    fpath, checksum, index_class, rules, tmpdir = args
+    renamer = _renamer(index_class)
+    moves = []
+    fd, tmpfile = tempfile.mkstemp(dir=tmpdir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for section in utils.iter_sections(fpath, checksum):
+                new_text, section_moves = renamer(section, rules)
+                if new_text is not None:
+                    moves.extend(section_moves)
+                    section = new_text
+                section += '\n\n'
+                f.write(section if isinstance(section, bytes) else section.encode('utf-8'))
+    except:
+        os.unlink(tmpfile)
+        raise
+    if not moves:
+        os.unlink(tmpfile)
+        return None, moves
+    return tmpfile, moves
 
-def rename(topdir, pairs, file=False):
+
+def _write_index(args):
+    """
+    把修改后的内容写回索引，保留原有的压缩格式
+    """
+    fpath, tmpfile = args
+    filepath = utils.index_path(fpath)
+    compressions = tuple(ext for ext in ('',) + tuple(sorted(utils.COMPRESSORS))
+                         if os.path.exists(filepath + ext)) or None
+    with utils.IndexWriter(filepath, compressions) as writer:
+        with open(tmpfile, 'rb') as f:
+            for data in iter(lambda: f.read(utils.CHUNK_SIZE), b''):
+                writer.write(data)
+    return filepath
+
+
+def _move_files(topdir, moves):
+    """
+    移动文件，链接文件则把链接目标复制到新路径。有文件移动失败时回滚
+    """
+    pool_mover = mover.PoolMover(os.path.join(topdir, 'dists', mover.JOURNAL_NAME))
+    if pool_mover.pending():
+        logger.warning('Rolling back interrupted rename')
+        if pool_mover.rollback():
+            return False
+    todo = []
+    copies = 0
+    for old, new in sorted(moves.items()):
+        old_path = os.path.join(topdir, old)
+        new_path = os.path.join(topdir, new)
+        if os.path.lexists(new_path):
+            logger.debug('new path already exists, maybe renamed before: %s', new)
+        elif not os.path.lexists(old_path):
+            logger.warning('file not found: %s', old)
+        elif os.path.islink(old_path):
+            # 从链接目标复制，链接保留
+            todo.append((old_path, new_path, mover.COPY))
+            copies += 1
+        else:
+            todo.append((old_path, new_path))
+    logger.info('Moving %d files, copying %d links', len(todo) - copies, copies)
+    if pool_mover.move(todo):
+        pool_mover.rollback()
+        return False
+    return True
+
+
+def rename(topdir, rules, file=False):
+    """
+    按规则修改所有索引中的软件包路径，rules为 {旧路径: 新路径} 或者 RenameRules
+    """
     index_dir = os.path.join(topdir, 'dists')
     if not os.path.isdir(index_dir):
         logger.error('%s 不是一个软件源目录', topdir)
         return 1
+    if isinstance(rules, dict):
+        rules = RenameRules(rules)
+
+    tmpdir = tempfile.mkdtemp(dir=index_dir, prefix='.rename')
+    try:
+        return _rename(topdir, index_dir, rules, file, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _rename(topdir, index_dir, rules, file, tmpdir):
+    # 每个索引只读一遍：修改后的内容写到临时文件，同时找出需要移动的文件
+    releases = [utils.Release.parse(release_file)
+                for release_file in sorted(glob.glob(os.path.join(index_dir, '*', 'Release')))]
+    tasks = []
+    for release in releases:
+        for name, index_class in (('Packages', utils.Packages), ('Sources', utils.Sources)):
+            for _, fpath in release.index_files(name):
+                tasks.append((release, fpath, index_class))
+    results = utils.parallel_map(
+        _rename_index,
+        [(fpath, release.index_checksum(fpath), index_class, rules, tmpdir)
+         for release, fpath, index_class in tasks],
+        worker_type='thread')
+
+    moves = {}
+    changes = defaultdict(list)
+    for (release, fpath, _), (tmpfile, index_moves) in zip(tasks, results):
+        for old, new in index_moves:
+            if moves.setdefault(old, new) != new:
+                logger.error('%s is renamed to both %s and %s', old, moves[old], new)
+                return 1
+        if tmpfile:
+            logger.debug('Found files to rename in %s', fpath)
+            changes[release.filepath].append((fpath, tmpfile))
+
+    targets = {}
+    for old, new in moves.items():
+        if targets.setdefault(new, old) != old:
+            logger.error('both %s and %s are renamed to %s', targets[new], old, new)
+            return 1
+    logger.info('%d files to rename in %d suites', len(moves), len(changes))
+
+    if file and not _move_files(topdir, moves):
+        logger.error('移动文件失败，没有修改索引')
+        return 1
 
-    # parse package index
-    for release_file in glob.glob(os.path.join(index_dir, '*', 'Release')):
-        release = utils.Release.parse(release_file)
-        release_changed = False
-        for packages in release.all_packages.values():
-            changed = False
-            for package in packages:
-                fn = package.filename
-                prefix_expr = r'(Filename: )'
-
-                if fn in pairs:
-                    changed = True
-                    logger.debug('Found %s in %s', fn, packages.filepath)
-                    new_fn = pairs[fn]
-                    # change package info
-                    package.text, match_n = re.subn(r'^' + prefix_expr + re.escape(fn) + '$',
-                                                    r'\g<1>' + new_fn,
-                                                    package.text,
-                                                    flags=re.M)
-                    if match_n < 0:
-                        logger.error('replace action not match any result')
-                        return 1
-                    if file:
-                        logger.debug('rename file')
-                        old = os.path.join(topdir, fn)
-                        new = os.path.join(topdir, new_fn)
-
-                        if os.path.exists(new):
-                            logger.debug(
-                                'new path already exists, maybe renamed before')
-                            continue
-
-                        new_dir = os.path.dirname(new)
-                        if not os.path.exists(new_dir):
-                            os.makedirs(new_dir)
-
-                        if os.path.islink(old):
-                            # 从链接目标复制
-                            os.system('cp "%s" "%s"' % (old, new))
-                        else:
-                            # 重命名
-                            os.rename(old, new)
-
-            if changed:
-                logger.debug('Rewriting: %s', packages.filepath)
-                packages.write()
-                release_changed = True
-
-        # update Release
-        if release_changed:
-            logger.debug('Rewriting Release file: %s', release_file)
-            release.write()
+    # 修改后的索引写回，每个系列的Release只生成一次
+    for release in releases:
+        changed = changes.get(release.filepath)
+        if not changed:
+            continue
+        for filepath in utils.parallel_map(_write_index, changed, worker_type='thread'):
+            logger.debug('Rewrote: %s', filepath)
+        logger.debug('Rewriting Release file: %s', release.filepath)
+        release.write()
     return 0
 
 
@@ -103,7 +268,7 @@ def main(argv=None):
     """
     args = docopt.docopt(cmd_doc, argv, help=True, version='1.0')
 
-    name_pairs = {}
+    name_pairs = []
 
     if args['--list']:
         logger.info('processing name list...')
@@ -115,16 +280,21 @@ def main(argv=None):
                     if not stripped:
                         continue
                     a, b = stripped.split(',')
-                    name_pairs[a.strip()] = b.strip()
+                    name_pairs.append((a.strip(), b.strip()))
                 except:
                     logger.warning(
                         'Unable to parse filename pair from: %s', line)
                     pass
 
     else:
-        name_pairs = {args['<origin>']: args['<new>']}
+        name_pairs = [(args['<origin>'], args['<new>'])]
+
+    if args['--regex']:
+        rules = RenameRules(patterns=name_pairs)
+    else:
+        rules = RenameRules(dict(name_pairs))
 
     return rename(os.path.abspath(args['<dir>']),
-                  name_pairs,
+                  rules,
                   file=args['--file']
                   )
@@ -8,25 +8,36 @@ Created on 2017-03-24
 
 cmd_doc = """
 从软件源中删除已经不在dists索引里的包，减少其占用空间
-Usage: archive-man strip <dir> [-b <backupdir>] [-d] [-i] [-p <pattern>...] [-f <pattern-file>]
+Usage: archive-man strip <dir> [-b <backupdir>] [-d] [-i] [-p <pattern>...] [-f <pattern-file>] [-r]
+                                 [--keep=<n>] [--newer-than=<date>]
+       archive-man strip <dir> -b <backupdir> (--complete|--rollback)
 
 dir: 软件源目录，里面应该有dists和软件包目录（通常取名为pool）
 
 options:
    -b, --backup=<backupdir>    多余的包不会被删除，而是移动到指定的备份目录中
+   --complete                  继续完成上次中断的移动
+   --rollback                  把上次中断前已经移动到备份目录的文件移回原处
    -d, --dry                   提示哪些文件会被删除，但并不执行
+   -r, --resume                和 --dry 一起使用，接着上次中断的位置继续，已经分析过的索引不再读取
    -h, --help                  show this help
    -i, --index                 双向删除：同时会将已经不存在于pool中的包从索引中删除
    -p, --pattern=<pattern>     额外将路径匹配pattern的软件包删除
    -f, --from-file=<pattern-file>
                                从文件中读取pattern
+   --keep=<n>                  保留策略：所有索引中的软件包按 (源码包, 架构) 分组，每组只保留
+                               版本最高的n个版本，其他版本从索引中删除，文件也一并删除
+   --newer-than=<date>         保留策略：保留文件修改时间晚于date（YYYY-MM-DD）的版本，
+                               与 --keep 同时使用时满足任一条件即保留。每组至少保留最高的版本
 
 """
 
 import os
 import glob
 import re
+import time
 from ..contrib import docopt
+from . import mover
 from . import utils
 
 import logging
@@ -34,9 +45,61 @@ import logging
 logger = logging.getLogger('archive_man')
 
 
-def strip(topdir, backup, index, dryrun=False, pattern=None):
+class Retention(object):
+    """
+    保留策略：把所有索引中的记录按 (源码包, 架构) 分组，每组保留版本最高的keep个版本，
+    以及文件修改时间晚于newer_than（时间戳）的版本，每组至少保留版本最高的一个。
+    版本指源码版本，binNMU等二进制版本号与源码不同的包归入其源码版本
+    """
+
+    def __init__(self, keep=None, newer_than=None):
+        self.keep = keep
+        self.newer_than = newer_than
+        self.versions = {}
+        self.retained = set()
+
+    @staticmethod
+    def _group(package):
+        if isinstance(package, utils.Source):
+            return package.source, 'source'
+        return package.source, package.arch
+
+    def add(self, topdir, package):
+        """
+        收集一条记录的版本，需要按日期保留时同时记录文件的修改时间
+        """
+        versions = self.versions.setdefault(self._group(package), {})
+        mtime = versions.get(package.source_version, 0)
+        if self.newer_than is not None:
+            file_list = package.files if isinstance(package, utils.Source) else \
+                [package.filename]
+            for filename in file_list:
+                try:
+                    mtime = max(mtime, os.path.getmtime(os.path.join(topdir, filename)))
+                except OSError:
+                    pass
+        versions[package.source_version] = mtime
+
+    def finish(self):
+        """
+        所有记录收集完后，计算每组保留的版本
+        """
+        for group, versions in self.versions.items():
+            ordered = sorted(versions, key=utils.version_key, reverse=True)
+            for n, version in enumerate(ordered):
+                if n == 0 or (self.keep is not None and n < self.keep) or \
+                        (self.newer_than is not None and versions[version] > self.newer_than):
+                    self.retained.add(group + (version,))
+        self.versions = {}
+
+    def keeps(self, package):
+        return self._group(package) + (package.source_version,) in self.retained
+
+
+def strip(topdir, backup, index, dryrun=False, pattern=None, resume=False, retention=None):
     """
     从软件源中删除已经不在dists索引里的包
+    retention 为 Retention 时，同时按保留策略删除索引中的旧版本
     """
     index_dir = os.path.join(topdir, 'dists')
     if not os.path.isdir(index_dir):
@@ -45,27 +108,90 @@ def strip(topdir, backup, index, dryrun=False, pattern=None):
 
     if backup and not os.path.exists(backup):
         os.makedirs(backup)
+    if backup and not dryrun:
+        pool_mover = mover.PoolMover(os.path.join(backup, mover.JOURNAL_NAME))
+        if pool_mover.pending():
+            logger.error('上次移动到 %s 时中断，请先使用 --complete 或 --rollback 处理', backup)
+            return 1
 
     # find all Packages and Sources
-    pool_files = set()
     keep_list = set()
 
     logger.debug('Collecting files')
-    for folder, _, subfiles in os.walk(topdir):
-        for subfile in subfiles:
-            if folder.startswith(index_dir):
-                continue
-            else:
-                pool_files.add(os.path.join(folder, subfile))
+    inventory = utils.scan_pool(topdir, exclude=['dists'])
+    pool_files = set(inventory)
+    release_files = glob.glob(os.path.join(index_dir, '*', 'Release'))
+
+    # 不需要修改索引时，引用索引中已经有所有被引用的文件，只重新读取变化了的索引
+    refs = None if index or pattern or retention else utils.ref_index(topdir)
+    if refs is not None:
+        logger.debug('Updating file references')
+        refs.sync()
+        for filename in refs.referenced():
+            package_abs_path = os.path.join(topdir, filename)
+            keep_list.add(package_abs_path)
+            poolfile = inventory.get(package_abs_path)
+            if poolfile and poolfile.link:
+                # 链接目标保留
+                keep_list.add(poolfile.link)
+        refs.close()
+        release_files = []
+
+    # 按保留策略删除时，需要先看过所有索引中的版本，同一个索引中的多个版本也要分别统计
+    if retention:
+        logger.debug('Collecting versions')
+        for release_file in release_files:
+            release = utils.Release.parse(release_file)
+            for name, index_class in (('Packages', utils.Packages), ('Sources', utils.Sources)):
+                for _, fpath in release.index_files(name):
+                    for package in index_class.iter_stanzas(
+                            fpath, checksum=release.index_checksum(fpath)):
+                        retention.add(topdir, package)
+        retention.finish()
+    rewrite = index or retention is not None
+
+    # 测试模式下记录每个索引分析的结果，中断后可以继续
+    checkpoint = None
+    analyzed = {}
+    if dryrun and release_files:
+        checkpoint = utils.Checkpoint('strip', [topdir, bool(index),
+                                                pattern.pattern if pattern else None,
+                                                retention and [retention.keep,
+                                                               retention.newer_than]])
+        if resume:
+            for fpath, changed, kept in checkpoint.load():
+                analyzed[fpath] = changed, kept
+        checkpoint.start(resume)
+    elif resume and not dryrun:
+        logger.warning('--resume only works with --dry, ignored')
 
     # parse package index
-    for release_file in glob.glob(os.path.join(index_dir, '*', 'Release')):
+    for release_file in release_files:
         release = utils.Release.parse(release_file)
         release_changed = False
-        for packages in release.all_packages.values() + release.all_sources.values():
-            new = utils.Packages(packages.filepath)
+        index_files = [(fpath, utils.Packages) for _, fpath in release.index_files('Packages')] + \
+            [(fpath, utils.Sources) for _, fpath in release.index_files('Sources')]
+        for fpath, index_class in index_files:
+            if fpath in analyzed:
+                changed, kept = analyzed[fpath]
+                keep_list.update(kept)
+                if changed:
+                    logger.debug('Index file need to rewrite: %s', utils.index_path(fpath))
+                continue
+            new = utils.Packages(utils.index_path(fpath))
             changed = False
+            kept = set()
+            # 有保留策略时索引中同名的每个版本都要保留或删除，否则同名的只取版本最高的
+            if retention:
+                packages = index_class.iter_stanzas(fpath, checksum=release.index_checksum(fpath))
+            else:
+                packages = index_class.iter_latest(fpath, checksum=release.index_checksum(fpath))
             for package in packages:
+                if retention and not retention.keeps(package):
+                    logger.debug('Expired: %s %s, remove from %s',
+                                 package.name, package.version, new.filepath)
+                    changed = True
+                    continue
                 if isinstance(package, utils.Source):
                     file_list = package.files
                 else:
@@ -74,26 +200,32 @@ def strip(topdir, backup, index, dryrun=False, pattern=None):
                     package_abs_path = os.path.join(topdir, filename)
                     if pattern and pattern.search(filename):
                         logger.debug('Matched file: %s', filename)
-                        if index:
+                        if rewrite:
                             logger.debug('Remove %s from %s',
-                                            package.name, packages.filepath)
+                                            package.name, new.filepath)
                             changed = True
                         break
-                    if index:
-                        if package_abs_path in pool_files:
-                            new[package.name] = package
+                    if index and package_abs_path not in pool_files:
+                        logger.debug('Missing file: %s', package_abs_path)
+                        logger.debug('Remove %s from %s',
+                                     package.name, new.filepath)
+                        changed = True
+                        break
+                    if rewrite:
+                        if retention:
+                            new[(package.name, package.version)] = package
                         else:
-                            logger.debug('Missing file: %s', package_abs_path)
-                            logger.debug('Remove %s from %s',
-                                         package.name, packages.filepath)
-                            changed = True
-                            break
-                    keep_list.add(package_abs_path)
-                    if os.path.islink(package_abs_path):
+                            new[package.name] = package
+                    kept.add(package_abs_path)
+                    poolfile = inventory.get(package_abs_path)
+                    if poolfile and poolfile.link:
                         # 链接目标保留
-                        keep_list.add(os.path.realpath(package_abs_path))
+                        kept.add(poolfile.link)
+            keep_list.update(kept)
+            if checkpoint:
+                checkpoint.add([fpath, changed, sorted(kept)])
 
-            if index and changed:
+            if rewrite and changed:
                 if dryrun:
                     logger.debug(
                         'Index file need to rewrite: %s', new.filepath)
@@ -108,17 +240,17 @@ def strip(topdir, backup, index, dryrun=False, pattern=None):
             release.write()
 
     # 开始删除或移动
+    if backup and not dryrun:
+        moves = [(filepath, backup + filepath.replace(topdir, '', 1))
+                 for filepath in sorted(pool_files - keep_list)]
+        logger.debug('Moving %d files to %s', len(moves), backup)
+        if pool_mover.move(moves):
+            return 1
+        logger.info('裁剪完成')
+        return 0
     for filepath in pool_files - keep_list:
         if dryrun:
             logger.debug('Find an unnecessary file: %s', filepath)
-        elif backup:
-            old_dir, _ = os.path.split(filepath)
-            back_dir = backup + old_dir.replace(topdir, '', 1)
-            if not os.path.exists(back_dir):
-                os.makedirs(back_dir)
-            cmd = 'mv "%s" "%s"' % (filepath, back_dir)
-            logger.debug('Excecuting: %s', cmd)
-            assert os.system(cmd) == 0
         else:
             logger.debug('Removing: %s', filepath)
             try:
@@ -126,6 +258,9 @@ def strip(topdir, backup, index, dryrun=False, pattern=None):
             except:
                 logger.error('remove failed: %s', filepath)
 
+    if checkpoint:
+        checkpoint.done()
+
     if dryrun:
         logger.info('测试模式完成，没有改动任何文件')
     else:
@@ -159,10 +294,34 @@ def main(argv=None):
                     continue
                 patterns.add(pattern)
 
+    if args['--complete'] or args['--rollback']:
+        pool_mover = mover.PoolMover(os.path.join(backupdir, mover.JOURNAL_NAME))
+        if not pool_mover.pending():
+            logger.error('%s 中没有未完成的移动', backupdir)
+            return 1
+        if args['--complete']:
+            failed = pool_mover.complete()
+        else:
+            failed = pool_mover.rollback()
+        return 1 if failed else 0
+
+    retention = None
+    if args['--keep'] or args['--newer-than']:
+        try:
+            retention = Retention(
+                keep=int(args['--keep']) if args['--keep'] else None,
+                newer_than=time.mktime(time.strptime(args['--newer-than'], '%Y-%m-%d'))
+                if args['--newer-than'] else None)
+        except ValueError:
+            logger.error('--keep 应为整数，--newer-than 的格式应为 YYYY-MM-DD')
+            return 1
+
     return strip(topdir=os.path.abspath(args['<dir>']),
                  backup=backupdir,
                  index=args['--index'],
                  dryrun=args['--dry'],
+                 resume=args['--resume'],
+                 retention=retention,
                  pattern=re.compile(
                      '|'.join('(%s)' % p for p in patterns)) if patterns else None
                  )
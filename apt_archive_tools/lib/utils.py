@@ -5,21 +5,62 @@ Created on 2017-2-22
 
 @author: xiewei
 '''
-import gzip
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import shutil
 import sys
 import tempfile
+import threading
+import time
+from email.utils import formatdate
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+import bz2
 import sqlite3
-from io import BytesIO
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 import requests
+import requests.adapters
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
 
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 from collections import defaultdict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from . import config
+from . import logging
+
+logger = logging.getLogger('archive_man')
 
 import re
 pkg_field_pattern = re.compile(r'^(?P<key>[^\s:]*): (?P<value>.+)',
@@ -28,6 +69,7 @@ src_field_pattern = re.compile(r'^(?P<key>[^\s:]*): (?P<value>.+)',
                                re.M)
 source_version_pattern = re.compile(r'(.+) \((.+)\)')
 files_pattern = re.compile(r'^ (\w{32})\s+(\d+) (.+)', re.M)
+sha256_files_pattern = re.compile(r'^ (\w{64})\s+(\d+) (.+)', re.M)
 dependency_pattern = re.compile(r'\s*(\S+) \((\S+) (\S+)\)')
 
 # cmp mixin
@@ -63,17 +105,944 @@ else:
         pass
 
 
+# 流式读取索引时每次读取的块大小
+CHUNK_SIZE = 1024 * 1024
+# 远程请求的超时时间（秒）、失败重试次数、连接池大小
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_POOL_SIZE = 16
+# 后台下载时每次读取的块大小和最多缓冲的块数
+HTTP_CHUNK_SIZE = 64 * 1024
+HTTP_PREFETCH_CHUNKS = 16
+
+_session = None
+_session_pid = None
+
+
+def http_session():
+    """
+    模块内共享的HTTP会话：保持连接复用，遇到连接错误或5xx时退避重试
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        # 进程池中fork出的子进程不能复用父进程的连接
+        session = requests.Session()
+        retries = Retry(total=HTTP_RETRIES, backoff_factor=0.5,
+                        status_forcelist=(500, 502, 503, 504))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                pool_maxsize=HTTP_POOL_SIZE,
+                                                max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def is_url(url):
+    """
+    是否远程文件，与 open_url 的判断一致
+    """
+    return '://' in url and not url.startswith('file://')
+
+
+def http_get(url, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return http_session().get(url, **kwargs)
+
+
+class FetchError(IOError):
+    """远程文件下载失败"""
+
+
+# 远程索引文件下载失败时依次尝试的其他压缩格式：{url: (下一个url, 其md5)}，由 Release.index_files 填写
+index_fallbacks = {}
+
+
 def read_url(url):
+    f = open_url(url)
+    if f is None:
+        return
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def open_url(url, checksum=None, prefetch=False):
+    """
+    以二进制流的方式打开本地文件或远程url，远程文件不存在时返回None。
+    远程文件会使用http缓存，checksum是Release中记录的md5，
+    缓存的内容与之一致时直接使用缓存，不再发送请求。
+    prefetch为True时远程文件在后台线程中下载
+    """
     if url.startswith('file://'):
         url = url[7:]
     if '://' not in url:
         # as file
-        return open(url, 'rb').read()
+        return open(url, 'rb')
+    elif http_cache is not None:
+        return http_cache.open(url, checksum, prefetch)
     else:
-        res_temp = requests.get(url, stream=True)
+        res_temp = http_get(url, stream=True)
+        state_tag = res_temp.status_code
+        if state_tag == 200:
+            res_temp.raw.decode_content = True
+            if prefetch:
+                return PrefetchReader(res_temp.raw)
+            return res_temp.raw
+        res_temp.close()
+        logger.warning('Unable to fetch %s: HTTP %s', url, state_tag)
+
+
+class PrefetchReader(object):
+    """
+    在后台线程中读取远程文件，主线程解压、解析的同时下载可以继续进行。
+    最多缓冲 max_chunks 块数据，内存占用与文件大小无关
+    """
+
+    def __init__(self, f, chunk_size=HTTP_CHUNK_SIZE, max_chunks=HTTP_PREFETCH_CHUNKS):
+        self.f = f
+        self.queue = Queue(max_chunks)
+        self.buffer = b''
+        self.eof = False
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._fetch, args=(chunk_size,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fetch(self, chunk_size):
+        try:
+            while not self.closed.is_set():
+                data = self.f.read(chunk_size)
+                self._put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def read(self, size=None):
+        """
+        每次最多返回后台读取到的一块数据，读完后返回空字符串
+        """
+        if size is None:
+            return b''.join(iter(lambda: self.read(HTTP_CHUNK_SIZE), b''))
+        if not self.buffer and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+            self.buffer = item
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.closed.set()
+        self.f.close()
+        self.thread.join()
+
+
+# 支持读取的压缩格式：扩展名 -> (文件头, 解压器)
+COMPRESSIONS = {
+    '.gz': (b'\x1f\x8b', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    '.bz2': (b'BZh', bz2.BZ2Decompressor),
+}
+if lzma is not None:
+    COMPRESSIONS['.xz'] = (b'\xfd7zXZ\x00', lzma.LZMADecompressor)
+# 本地索引按解压开销从小到大选择
+DECODE_ORDER = ['', '.gz', '.xz', '.bz2']
+
+
+# 生成索引文件时使用的压缩器
+COMPRESSORS = {
+    '.gz': lambda: zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Compressor,
+}
+if lzma is not None:
+    COMPRESSORS['.xz'] = lzma.LZMACompressor
+# Packages、Sources默认生成的格式
+INDEX_COMPRESSIONS = tuple(ext for ext in ('', '.gz', '.xz')
+                           if not ext or ext in COMPRESSORS)
+# 写入索引时计算的校验值
+INDEX_HASHES = ('md5', 'sha1', 'sha256')
+# 写入索引时的缓冲区大小
+WRITE_BUFFER_SIZE = 256 * 1024
+
+# 本进程中写入的索引文件的大小和校验值，生成Release时不必重新计算
+index_manifest = {}
+
+# Release中的校验值段落及对应的算法
+RELEASE_HASHES = OrderedDict([('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256')])
+# Release中列出的文件，同apt-ftparchive的默认设置
+RELEASE_PATTERNS = ['Packages', 'Packages.*', 'Sources', 'Sources.*', 'Release',
+                    'Contents-*', 'Index', 'Translation-*', 'md5sum.txt',
+                    'Components-*', 'icons-*']
+# Release头部可以写入的字段及其顺序，Date、Acquire-By-Hash在生成时填写
+RELEASE_FIELDS = ['Origin', 'Label', 'Suite', 'Version', 'Codename',
+                  'NotAutomatic', 'ButAutomaticUpgrades', 'Architectures',
+                  'Components', 'Description', 'Signed-By']
+# by-hash目录中每个索引文件保留的版本数
+BY_HASH_KEEP = 3
+
+
+def compression_of(filepath):
+    """
+    文件的压缩格式扩展名，未压缩或不支持的格式返回空字符串
+    """
+    ext = os.path.splitext(filepath)[1]
+    if ext in COMPRESSIONS:
+        return ext
+    return ''
+
+
+def iter_chunks(url, chunk_size=CHUNK_SIZE, checksum=None):
+    """
+    分块读取文件内容，.gz、.bz2、.xz文件会被逐块解压。
+    远程文件无法下载时，如果是Release中列出的索引文件，改为读取其他压缩格式的同一文件，
+    都无法下载时抛出FetchError
+    """
+    try:
+        f = open_url(url, checksum, prefetch=True)
+    except requests.RequestException as e:
+        logger.warning('Unable to fetch %s: %s', url, e)
+        f = None
+    if f is None:
+        if url not in index_fallbacks:
+            raise FetchError('Unable to fetch %s' % url)
+        next_url, next_checksum = index_fallbacks[url]
+        logger.info('Trying %s instead', next_url)
+        for chunk in iter_chunks(next_url, chunk_size, next_checksum):
+            yield chunk
+        return
+    magic, new_decompressor = COMPRESSIONS.get(compression_of(url), (None, None))
+    decompressor = None
+    try:
+        # 读够文件头的长度再判断是否压缩，读取的块可能比文件头还短
+        head = b''
+        while magic and len(head) < len(magic):
+            data = f.read(chunk_size)
+            if not data:
+                break
+            head += data
+        if magic and head.startswith(magic):
+            decompressor = new_decompressor()
+        # 否则服务器可能已经解压过了
+        while True:
+            if head:
+                data, head = head, b''
+            else:
+                data = f.read(chunk_size)
+            if not data:
+                break
+            if decompressor is None:
+                yield data
+                continue
+            while data:
+                if getattr(decompressor, 'eof', False):
+                    # 上一段压缩数据正好在块的边界结束
+                    decompressor = new_decompressor()
+                try:
+                    yield decompressor.decompress(data)
+                except EOFError:
+                    # python2的BZ2Decompressor没有eof属性，结束后再写入数据时报错
+                    decompressor = new_decompressor()
+                    continue
+                # 多段压缩数据拼接的文件
+                data = decompressor.unused_data
+                if data:
+                    decompressor = new_decompressor()
+        if hasattr(decompressor, 'flush'):
+            yield decompressor.flush()
+    finally:
+        f.close()
+
+
+def iter_lines(url, checksum=None):
+    """
+    逐行读取文件内容（不含换行符），不会把整个文件读入内存
+    """
+    rest = b''
+    for chunk in iter_chunks(url, checksum=checksum):
+        if not chunk:
+            continue
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8') if PY3 else line
+    if rest:
+        yield rest.decode('utf-8') if PY3 else rest
+
+
+def iter_sections(url, checksum=None):
+    """
+    逐段读取Packages、Sources这类以空行分隔的索引文件
+    """
+    section = []
+    for line in iter_lines(url, checksum):
+        if line:
+            section.append(line)
+        elif section:
+            yield '\n'.join(section)
+            section = []
+    if section:
+        yield '\n'.join(section)
+
+
+class _HashingFile(object):
+    """
+    写入文件的同时计算大小和校验值
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.hashes = [(name, hashlib.new(name)) for name in INDEX_HASHES]
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        for _, h in self.hashes:
+            h.update(data)
+
+    def close(self):
+        self.f.close()
+
+    def digests(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashes)
+
+
+class IndexWriter(object):
+    """
+    一次写入同时生成未压缩和各种压缩格式的索引文件，边写边计算每个文件的大小和校验值，
+    全部写完后才把临时文件改名替换旧文件，写入出错时旧文件保持不变。
+    用法：
+        with IndexWriter('.../Packages') as writer:
+            writer.write(text)
+    完成后 writer.files 是 {文件路径: {'size': .., 'md5': .., 'sha1': .., 'sha256': ..}}
+    """
+
+    def __init__(self, filepath, compressions=None):
+        self.filepath = filepath
+        self.compressions = INDEX_COMPRESSIONS if compressions is None else compressions
+        self.files = {}
+        self.buffer = []
+        self.buffered = 0
+        self.outputs = []
+        dirname, basename = os.path.split(os.path.abspath(filepath))
+        try:
+            for ext in self.compressions:
+                fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix='.' + basename + ext,
+                                               suffix='.tmp')
+                compressor = COMPRESSORS[ext]() if ext else None
+                self.outputs.append((filepath + ext, tmpfile, compressor,
+                                     _HashingFile(os.fdopen(fd, 'wb'))))
+        except:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        for _, _, compressor, f in self.outputs:
+            f.write(compressor.compress(data) if compressor else data)
+
+    def close(self):
+        # 先把所有格式都写完，再一起改名，避免一部分格式已经替换、另一部分出错还是旧的
+        try:
+            self._flush()
+            for path, tmpfile, compressor, f in self.outputs:
+                if compressor:
+                    f.write(compressor.flush())
+                f.close()
+                os.chmod(tmpfile, 0o644)
+        except:
+            self.abort()
+            raise
+        for path, tmpfile, compressor, f in self.outputs:
+            os.rename(tmpfile, path)
+            info = f.digests()
+            info['size'] = f.size
+            info['mtime'] = os.stat(path).st_mtime
+            self.files[path] = info
+            index_manifest[os.path.abspath(path)] = info
+        self.outputs = []
+        # 删除不再生成的旧格式
+        for ext in COMPRESSORS:
+            if ext not in self.compressions and os.path.exists(self.filepath + ext):
+                os.unlink(self.filepath + ext)
+
+    def abort(self):
+        for _, tmpfile, _, f in self.outputs:
+            f.close()
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+        self.outputs = []
+
+
+def index_path(filepath):
+    """
+    压缩索引文件对应的未压缩文件路径
+    """
+    ext = compression_of(filepath)
+    if ext:
+        return filepath[:-len(ext)]
+    return filepath
+
+
+class IndexCache(object):
+    """
+    解析后的索引文件的磁盘缓存。
+    以索引文件路径加上校验值为键：校验值是Release中记录的md5，本地文件还会加上
+    文件的inode、大小和修改时间，所以索引内容变化后旧缓存自动失效
+    """
+    # 每批缓存的记录数，读缓存时也是逐批读取
+    BATCH_SIZE = 1000
+    # 缓存格式版本，加入校验值中；以前下载失败时会把空的结果存入缓存，改变版本让这些缓存失效
+    VERSION = '2'
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def _entry(self, filepath, checksum, suffix):
+        """
+        缓存文件路径，无法确定索引文件是否变化时返回None
+        """
+        validator = self.VERSION + ':' + (checksum or '')
+        if filepath.startswith('file://'):
+            filepath = filepath[7:]
+        if '://' not in filepath:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return None
+            filepath = os.path.abspath(filepath)
+            validator += ':%d:%d:%r' % (st.st_ino, st.st_size, st.st_mtime)
+        elif not checksum:
+            return None
+        entry_dir = os.path.join(self.cachedir,
+                                 hashlib.sha1(filepath.encode('utf-8')).hexdigest())
+        return os.path.join(entry_dir,
+                            hashlib.sha1(validator.encode('utf-8')).hexdigest() + suffix)
+
+    def _store(self, entry, tmpfile):
+        """
+        放入新的缓存，同一个索引文件的旧缓存删除
+        """
+        entry_dir = os.path.dirname(entry)
+        for old in os.listdir(entry_dir):
+            if not old.endswith('.tmp'):
+                os.unlink(os.path.join(entry_dir, old))
+        os.rename(tmpfile, entry)
+
+    def _tempfile(self, entry):
+        entry_dir = os.path.dirname(entry)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        fd, tmpfile = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), tmpfile
+
+    def iter_stanzas(self, filepath, checksum=None):
+        """
+        逐条读取缓存的记录，没有缓存时返回None
+        """
+        entry = self._entry(filepath, checksum, '.pickle')
+        if not entry or not os.path.exists(entry):
+            return None
+
+        def iter_entry():
+            with open(entry, 'rb') as f:
+                while True:
+                    try:
+                        batch = pickle.load(f)
+                    except EOFError:
+                        break
+                    for stanza in batch:
+                        yield stanza
+        return iter_entry()
+
+    def cached_stanzas(self, filepath, stanzas, checksum=None):
+        """
+        边读取记录边写入缓存，所有记录都读完后缓存才生效。
+        读取中出错（如下载失败）时异常直接抛出，临时文件被删除，不会留下缓存
+        """
+        entry = self._entry(filepath, checksum, '.pickle')
+        if not entry:
+            for stanza in stanzas:
+                yield stanza
+            return
+        f, tmpfile = self._tempfile(entry)
+        try:
+            batch = []
+            for stanza in stanzas:
+                batch.append(stanza)
+                if len(batch) >= self.BATCH_SIZE:
+                    pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+                yield stanza
+            # 到这里说明源文件已经完整读完
+            if batch:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            self._store(entry, tmpfile)
+        finally:
+            f.close()
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    def drop(self, url):
+        """
+        删除一个远程索引文件的所有缓存
+        """
+        shutil.rmtree(os.path.join(self.cachedir, hashlib.sha1(url.encode('utf-8')).hexdigest()),
+                      ignore_errors=True)
+
+    def load_file(self, filepath, dest, checksum=None, suffix='.db'):
+        """
+        把缓存的文件复制到 dest，没有缓存时返回False
+        """
+        entry = self._entry(filepath, checksum, suffix)
+        if not entry or not os.path.exists(entry):
+            return False
+        shutil.copyfile(entry, dest)
+        return True
+
+    def store_file(self, filepath, src, checksum=None, suffix='.db'):
+        """
+        把 src 文件复制一份作为缓存
+        """
+        entry = self._entry(filepath, checksum, suffix)
+        if not entry:
+            return
+        f, tmpfile = self._tempfile(entry)
+        try:
+            with open(src, 'rb') as fsrc:
+                shutil.copyfileobj(fsrc, f)
+            f.close()
+            self._store(entry, tmpfile)
+        finally:
+            f.close()
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+
+class HttpCache(object):
+    """
+    远程文件的磁盘缓存。
+    每个url保存最后一次下载的内容及其ETag、Last-Modified和md5，
+    再次下载时发送条件请求，服务器返回304就直接使用缓存
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def _entry_dir(self, url):
+        return os.path.join(self.cachedir,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _meta(self, url):
+        """
+        缓存信息，没有缓存或缓存不完整时返回None
+        """
+        entry_dir = self._entry_dir(url)
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        meta['body'] = os.path.join(entry_dir, meta['md5'])
+        if not os.path.exists(meta['body']):
+            return None
+        return meta
+
+    def open(self, url, checksum=None, prefetch=False):
+        meta = self._meta(url)
+        headers = {}
+        if meta is not None:
+            if checksum and meta['md5'] == checksum:
+                # 与Release中的校验值一致，不需要再下载
+                return open(meta['body'], 'rb')
+            if not checksum:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+        res_temp = http_get(url, stream=True, headers=headers)
         state_tag = res_temp.status_code
+        if state_tag == 304 and meta is not None:
+            res_temp.close()
+            return open(meta['body'], 'rb')
         if state_tag == 200:
-            return res_temp.content
+            res_temp.raw.decode_content = True
+            reader = _CachingReader(self, url, res_temp, checksum)
+            if prefetch:
+                return PrefetchReader(reader)
+            return reader
+        res_temp.close()
+        logger.warning('Unable to fetch %s: HTTP %s', url, state_tag)
+
+    def drop(self, url):
+        """
+        删除一个url的缓存
+        """
+        shutil.rmtree(self._entry_dir(url), ignore_errors=True)
+
+    def _tempfile(self, url):
+        entry_dir = self._entry_dir(url)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        fd, tmpfile = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), tmpfile
+
+    def _store(self, url, tmpfile, md5sum, headers):
+        """
+        下载完成的内容放入缓存，同一个url的旧内容删除
+        """
+        entry_dir = self._entry_dir(url)
+        os.rename(tmpfile, os.path.join(entry_dir, md5sum))
+        f, tmpmeta = self._tempfile(url)
+        with f:
+            f.write(json.dumps({'url': url,
+                                'md5': md5sum,
+                                'etag': headers.get('ETag'),
+                                'last_modified': headers.get('Last-Modified'),
+                                }).encode('utf-8'))
+        os.rename(tmpmeta, os.path.join(entry_dir, 'meta.json'))
+        for old in os.listdir(entry_dir):
+            if old not in (md5sum, 'meta.json') and not old.endswith('.tmp'):
+                os.unlink(os.path.join(entry_dir, old))
+
+
+class _CachingReader(object):
+    """
+    读取远程文件的同时写入http缓存，完整读完后缓存才生效。
+    内容与Release中的md5不一致时（如镜像正在同步）抛出FetchError，不留下任何缓存
+    """
+
+    def __init__(self, cache, url, response, checksum=None):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.checksum = checksum
+        self.md5 = hashlib.md5()
+        self.f, self.tmpfile = cache._tempfile(url)
+
+    def read(self, size=None):
+        data = self.response.raw.read(size)
+        if data:
+            self.f.write(data)
+            self.md5.update(data)
+        if not data or size is None:
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        md5sum = self.md5.hexdigest()
+        if self.checksum and md5sum != self.checksum:
+            os.unlink(self.tmpfile)
+            # 已经交给解析的数据不可信，这个url的下载缓存和解析结果缓存都删除
+            self.cache.drop(self.url)
+            if index_cache is not None:
+                index_cache.drop(self.url)
+            raise FetchError('md5 of %s does not match the Release file' % self.url)
+        self.cache._store(self.url, self.tmpfile, md5sum,
+                          self.response.headers)
+
+    def close(self):
+        if self.f is not None:
+            # 没有读完
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.tmpfile):
+            os.unlink(self.tmpfile)
+        self.response.close()
+
+
+# 缓存目录设为空时不使用缓存
+index_cache = IndexCache(config.CACHEDIR) if config.CACHEDIR else None
+http_cache = HttpCache(os.path.join(config.CACHEDIR, 'http')) if config.CACHEDIR else None
+
+
+class FileLock(object):
+    """
+    用flock实现的进程间互斥锁，已被占用时等待
+    用法（或者调用acquire、release）：
+        with FileLock(path):
+            ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def acquire(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.f = open(self.path, 'a')
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            logger.info('Waiting for lock: %s', self.path)
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+# 断点记录写到磁盘的间隔（秒）
+CHECKPOINT_INTERVAL = 60
+
+
+class Checkpoint(object):
+    """
+    长时间运行的任务的断点记录。每处理完一项追加一行json到记录文件，
+    每隔CHECKPOINT_INTERVAL秒刷到磁盘，中断后可以用load读出已完成的项继续执行，
+    任务完成时调用done删除记录。
+    记录文件由任务名和参数决定，参数不同的任务互不影响
+    """
+
+    def __init__(self, name, params):
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        self.filepath = os.path.join(config.CACHEDIR or tempfile.gettempdir(), 'checkpoint',
+                                     '%s-%s.json' % (name, key))
+        self.params = params
+        self.f = None
+        self.last_sync = 0
+        # load读到的有效记录的结尾位置，没有有效记录时为None
+        self.valid_size = None
+
+    def load(self):
+        """
+        读出上次记录的所有项，没有记录时返回空列表
+        """
+        records = []
+        self.valid_size = None
+        try:
+            f = open(self.filepath, 'rb')
+        except (IOError, OSError):
+            logger.warning('No checkpoint to resume from, starting over')
+            return records
+        size = 0
+        with f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 中断时写了一半的行
+                    break
+                try:
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    break
+                size += len(line)
+        if not records or records[0] != {'params': self.params}:
+            logger.warning('Checkpoint %s does not match, starting over', self.filepath)
+            return []
+        self.valid_size = size
+        logger.info('Resuming from checkpoint: %d items done', len(records) - 1)
+        return records[1:]
+
+    def start(self, resume=False):
+        """
+        开始记录，resume为真且load读到了有效记录时接着写，
+        截掉结尾写了一半的行；否则重新开始
+        """
+        dirname = os.path.dirname(self.filepath)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # 行缓冲：进程被杀掉时已写的记录不丢失，系统崩溃时最多丢失最近一个间隔的记录
+        if resume and self.valid_size is not None and os.path.exists(self.filepath):
+            with open(self.filepath, 'r+b') as f:
+                f.truncate(self.valid_size)
+            self.f = open(self.filepath, 'a', 1)
+        else:
+            self.f = open(self.filepath, 'w', 1)
+            self.f.write(json.dumps({'params': self.params}) + '\n')
+        self.last_sync = time.time()
+
+    def add(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        if time.time() - self.last_sync >= CHECKPOINT_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.time()
+
+    def close(self):
+        """
+        中断时保留记录
+        """
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    def done(self):
+        self.close()
+        try:
+            os.remove(self.filepath)
+        except OSError:
+            pass
+
+
+def parallel_map(func, items, workers=None, worker_type=None, chunksize=1):
+    """
+    用线程池或进程池并发执行 func，按 items 的顺序返回结果。
+    进程池要求 func 是模块级函数，参数和结果都可以pickle；
+    items很多而每个都很快时，用chunksize减少进程间通信的次数
+    """
+    items = list(items)
+    workers = workers or config.WORKERS or multiprocessing.cpu_count()
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    if (worker_type or config.WORKER_TYPE) == 'process':
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        result = pool.map(func, items, chunksize=chunksize)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return result
+
+
+# 扫描目录时并发的线程数，主要是等待IO，与CPU个数无关
+SCAN_THREADS = 16
+
+
+class PoolFile(object):
+    """
+    目录扫描得到的文件：路径、大小（未要求时为None）、inode、符号链接的目标（不是链接时为None）
+    """
+    __slots__ = ['path', 'size', 'inode', 'link']
+
+    def __init__(self, path, size, inode, link):
+        self.path = path
+        self.size = size
+        self.inode = inode
+        self.link = link
+
+
+def _scan_dir(args):
+    """
+    扫描一个目录，返回 (文件列表, 子目录列表)，recursive为真时子目录也扫描完
+    select不为None时，select(路径)为假的普通文件直接跳过
+    """
+    folder, recursive, with_size, select = args
+    files = []
+    subdirs = []
+    pending = [folder]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = list(scandir(current))
+        except OSError as e:
+            logger.warning('Cannot scan %s: %s', current, e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                (pending if recursive else subdirs).append(entry.path)
+                continue
+            selected = select is None or select(entry.path)
+            link = None
+            size = None
+            if entry.is_symlink():
+                if entry.is_dir():
+                    # 与os.walk一致，指向目录的链接既不进入也不算文件
+                    continue
+                # 直接读链接内容，不用realpath逐级lstat路径中的每一层；
+                # 只有链接指向的还是链接时才完整解析
+                link = os.path.normpath(os.path.join(current, os.readlink(entry.path)))
+                if os.path.islink(link):
+                    link = os.path.realpath(entry.path)
+            elif not selected:
+                continue
+            if with_size and selected:
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    # 链接目标不存在
+                    pass
+            files.append(PoolFile(entry.path, size, entry.inode(), link))
+    return files, subdirs
+
+
+def scan_pool(topdir, exclude=(), with_size=False, threads=None, select=None):
+    """
+    扫描topdir下的所有文件（不跟随目录链接），返回 {路径: PoolFile}
+    exclude为不扫描的顶层目录名，如 ['dists']
+    select为过滤函数，只返回select(路径)为真的文件；符号链接总是返回（不取大小），
+    以便找到其他文件的链接目标
+    先逐层展开上面两层目录，再用线程池并发递归扫描下面的各个子目录树。
+    利用scandir返回的文件类型和inode，只有符号链接和需要大小时才会额外stat
+    """
+    workers = threads or SCAN_THREADS
+    inventory = {}
+    files, folders = _scan_dir((topdir, False, with_size, select))
+    folders = [folder for folder in folders if os.path.basename(folder) not in exclude]
+    for f in files:
+        inventory[f.path] = f
+    for depth in range(3):
+        recursive = depth == 2
+        expanded = []
+        for files, subdirs in parallel_map(_scan_dir,
+                                           [(folder, recursive, with_size, select)
+                                            for folder in folders],
+                                           workers=workers, worker_type='thread'):
+            for f in files:
+                inventory[f.path] = f
+            expanded.extend(subdirs)
+        folders = expanded
+    return inventory
+
+
+def _parse_index(args):
+    index_class, fpath, checksum = args
+    return index_class.parse(fpath, checksum)
 
 
 class Release(object):
@@ -90,21 +1059,36 @@ class Release(object):
         self.contents_files = {}
         self.hash_files = {}
         self.files_hash = {}
+        self.files_size = {}
+        self.checksums = {}
         self.extra_data = extra_data
 
     def _parse(self):
         self.content = read_url(self.filepath)
         if isinstance(self.content, bytes):
             self.content = self.content.decode('utf-8')
-        for k, v in re.findall(r'(\w+): ?(.+$)', self.content, re.M):
+        for k, v in re.findall(r'^([\w-]+): ?(.+)$', self.content, re.M):
             self.data[k] = v
 
-        self.files = [fileinfo[2]
-                      for fileinfo in re.findall(files_pattern, self.content)]
-
-        for md5sum, size, path in re.findall(files_pattern, self.content):
+        # MD5Sum、SHA1、SHA256各段落，只有SHA256的Release也能列出文件
+        files = OrderedDict()
+        hash_name = None
+        for line in self.content.splitlines():
+            if not line.startswith(' '):
+                hash_name = RELEASE_HASHES.get(line.rstrip().rstrip(':'))
+                continue
+            fileinfo = line.split()
+            if hash_name is None or len(fileinfo) != 3:
+                continue
+            checksum, size, path = fileinfo
+            self.checksums.setdefault(hash_name, {})[path] = checksum
+            self.files_size[path] = int(size)
+            files[path] = True
+        self.files = list(files)
+
+        self.files_hash = self.checksums.get('md5', {})
+        for path, md5sum in self.files_hash.items():
             self.hash_files[md5sum] = path
-            self.files_hash[path] = md5sum
 
         return
 
@@ -129,94 +1113,225 @@ class Release(object):
         self.load_index('Contents')
         return self.contents_files
 
-    def load_index(self, name='Packages'):
+    def _index_info(self, name):
         if name == 'Packages':
             index_list = self.packages_files
-            pattern = re.compile(r'^Packages(\.gz){0,1}$')
+            pattern = re.compile(r'^Packages(\.\w+){0,1}$')
             index_class = Packages
         elif name == 'Sources':
             index_list = self.sources_files
-            pattern = re.compile(r'^Sources(\.gz){0,1}$')
+            pattern = re.compile(r'^Sources(\.\w+){0,1}$')
             index_class = Sources
         elif name == 'Contents':
             index_list = self.contents_files
-            pattern = re.compile(r'^Contents-\w+(\.gz){0,1}$')
+            pattern = re.compile(r'^Contents-\w+(\.\w+){0,1}$')
             index_class = ContentsInDB
         else:
             raise NotImplementedError()
+        return index_list, pattern, index_class
 
-        if index_list:
-            return
+    def index_files(self, name='Packages'):
+        """
+        Release中列出的、实际存在的某类索引文件
+        返回 [(未压缩的相对路径, 实际读取的路径), ...]
+        """
+        _, pattern, _ = self._index_info(name)
+
+        variants = OrderedDict()
         for fn in self.files:
             match = pattern.match(os.path.basename(fn))
-            if match:
-                if match.groups()[0] == '.gz':
-                    # gzipped
-                    fpath = os.path.join(os.path.dirname(self.filepath), fn)
-                    fn = fn.rsplit('.', 1)[0]
-                else:
-                    fpath = os.path.join(os.path.dirname(self.filepath), fn)
-            else:
+            if not match:
                 continue
-
-            if fn in index_list:
-                # 已经统计的
+            if match.groups()[0] and not compression_of(fn):
+                # 不支持的压缩格式
                 continue
-            url_tag = re.findall(
-                r"^((https?|ftp)://|(www|ftp)\.)[a-zA-Z0-9-]+(\.[a-zA-Z0-9-]+)+([/?].*)?$", fpath)
-            if url_tag:
-                res_temp = requests.head(fpath)
-                state_tag = res_temp.status_code
-                if state_tag == 200:
-                    index_list[fn] = index_class.parse(fpath)
+            fpath = os.path.join(os.path.dirname(self.filepath), fn)
+            variants.setdefault(index_path(fn), []).append(fpath)
+
+        found = []
+        for fn, fpaths in variants.items():
+            if is_url(fpaths[0]):
+                # 远程文件不再逐个探测是否存在，正常情况下读取时只发一次请求。
+                # 选Release中记录的大小最小的，下载量最少；
+                # Release中常常列出了服务器上并不存在的未压缩文件，所以大小相同时也优先用压缩过的
+                fpaths = sorted(fpaths,
+                                key=lambda f: (self.files_size.get(self._relative(f), sys.maxsize),
+                                               not compression_of(f)))
+                fpath = fpaths[0]
+                # 选中的文件下载失败时按顺序换用其他格式
+                for f, next_f in zip(fpaths, fpaths[1:]):
+                    index_fallbacks[f] = (next_f, self.index_checksum(next_f))
             else:
-                if not os.path.isfile(fpath):
+                # 本地文件选解压开销最小的
+                fpaths = [f for f in fpaths if os.path.isfile(f)]
+                if not fpaths:
                     # 已经删除了的索引文件就不要管了
                     continue
-                if os.path.exists(fpath):
-                    index_list[fn] = index_class.parse(fpath)
+                fpath = min(fpaths, key=lambda f: DECODE_ORDER.index(compression_of(f)))
+            found.append((fn, fpath))
+        return found
+
+    def _relative(self, fpath):
+        """
+        索引文件在Release中记录的相对路径
+        """
+        return fpath[len(os.path.dirname(self.filepath)):].lstrip('/')
+
+    def index_checksum(self, fpath):
+        """
+        Release中记录的索引文件md5
+        """
+        return self.files_hash.get(self._relative(fpath))
+
+    def load_index(self, name='Packages', workers=None):
+        """
+        并发解析所有name类型的索引文件，workers为0或None时使用配置文件中的设置
+        """
+        index_list, _, index_class = self._index_info(name)
+
+        if index_list:
+            return
+        index_files = self.index_files(name)
+        # sqlite连接不能在进程间传递
+        worker_type = 'thread' if index_class is ContentsInDB else None
+        results = parallel_map(_parse_index,
+                               [(index_class, fpath, self.index_checksum(fpath))
+                                for _, fpath in index_files],
+                               workers=workers, worker_type=worker_type)
+        for (fn, _), index in zip(index_files, results):
+            index_list[fn] = index
         return
 
+    def _release_files(self, topdir):
+        """
+        需要列在Release中的文件，返回排序后的相对路径
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(topdir):
+            if 'by-hash' in dirnames:
+                dirnames.remove('by-hash')
+            for fn in filenames:
+                if dirpath == topdir and fn in ('Release', 'InRelease', 'Release.gpg'):
+                    continue
+                if any(fnmatch.fnmatch(fn, pattern) for pattern in RELEASE_PATTERNS):
+                    found.append(os.path.relpath(os.path.join(dirpath, fn), topdir))
+        return sorted(found)
+
+    def _file_info(self, topdir, path, release_mtime):
+        """
+        文件的大小和校验值，尽量使用已知的结果，只对不知道的文件重新计算：
+        1. 本进程中刚写入的索引文件
+        2. 旧Release中的记录，要求文件大小一致，且ctime早于旧Release。
+           从备份恢复的文件可以保留mtime，但ctime总是恢复的时间，不会误用旧的校验值
+        """
+        fpath = os.path.join(topdir, path)
+        st = os.stat(fpath)
+        info = index_manifest.get(os.path.abspath(fpath))
+        if info and info['size'] == st.st_size and info['mtime'] == st.st_mtime:
+            return info
+        if release_mtime and st.st_ctime < release_mtime and \
+                self.files_size.get(path) == st.st_size:
+            info = dict((hash_name, self.checksums.get(hash_name, {}).get(path))
+                        for hash_name in RELEASE_HASHES.values())
+            if all(info.values()):
+                info['size'] = st.st_size
+                return info
+        logger.debug('Hashing %s', fpath)
+        info = file_hashes(fpath, RELEASE_HASHES.values())
+        info['size'] = st.st_size
+        return info
+
+    @staticmethod
+    def _link_by_hash(fpath, info):
+        """
+        在索引文件所在目录的by-hash中以校验值为名保存一份，并删除过旧的版本
+        """
+        dirpath = os.path.dirname(fpath)
+        for section, hash_name in RELEASE_HASHES.items():
+            hash_dir = os.path.join(dirpath, 'by-hash', section)
+            if not os.path.isdir(hash_dir):
+                os.makedirs(hash_dir)
+            target = os.path.join(hash_dir, info[hash_name])
+            if not os.path.exists(target):
+                try:
+                    os.link(fpath, target)
+                except OSError:
+                    shutil.copy2(fpath, target)
+
+    @staticmethod
+    def _prune_by_hash(topdir, files):
+        """
+        by-hash中除当前版本外，每个索引文件只保留最近的几个版本
+        """
+        current = defaultdict(list)
+        for path, info in files.items():
+            current[os.path.join(topdir, os.path.dirname(path), 'by-hash')].append(info)
+        for by_hash_dir, infos in current.items():
+            for section, hash_name in RELEASE_HASHES.items():
+                hash_dir = os.path.join(by_hash_dir, section)
+                in_use = set(info[hash_name] for info in infos)
+                entries = sorted(os.listdir(hash_dir),
+                                 key=lambda fn: os.path.getmtime(os.path.join(hash_dir, fn)),
+                                 reverse=True)
+                for fn in entries[len(infos) * BY_HASH_KEEP:]:
+                    if fn not in in_use:
+                        os.unlink(os.path.join(hash_dir, fn))
+
     def write(self):
-        conf = 'APT::FTPArchive::Release {'
-        for k, v in self.data.items():
-            if k == 'Date':
-                continue
-            conf += '%s "%s";' % (k, v)
-        conf += '};\nAPT::FTPArchive::DoByHash yes;'
-
-        # write conf
-        import tempfile
-        tmpconf = tempfile.mktemp('.conf')
-        with open(tmpconf, 'wb') as f:
-            if not isinstance(conf, bytes):
-                conf = conf.encode('utf-8')
-            f.write(conf)
-        # generate Release
+        """
+        生成Release文件并签名
+        索引文件的校验值来自刚写入时的计算结果或旧的Release，只有未知的文件才重新读取计算
+        """
         topdir = os.path.dirname(self.filepath)
-        os.system(
-            'rm -f "%(top)s"/InRelease "%(top)s"/Release.gpg "%(top)s"/Release' % {'top': topdir})
-
-        temp_release = tempfile.mktemp()
-        os.system('apt-ftparchive -c %(conf)s release %(top)s --contents > "%(release)s"' % {
-            'conf': tmpconf,
-            'top': topdir,
-            'release': temp_release
-        })
-        with open(temp_release, 'rb') as f:
-            content = f.read()
-        for k, v in self.extra_data.items():
-            head = '%s: %s\n' % (k, v)
-            if not isinstance(head, bytes):
-                head = head.encode('utf-8')
-            content = head + content
-        with open(os.path.join(topdir, 'Release'), 'wb') as f:
-            f.write(content)
-        # remove Packages and Sources
+        release_file = os.path.join(topdir, 'Release')
+        release_mtime = os.path.getmtime(release_file) if os.path.exists(release_file) else None
+        for fn in ('InRelease', 'Release.gpg', 'Release'):
+            if os.path.exists(os.path.join(topdir, fn)):
+                os.unlink(os.path.join(topdir, fn))
+
+        files = OrderedDict()
+        for path in self._release_files(topdir):
+            files[path] = self._file_info(topdir, path, release_mtime)
+            self._link_by_hash(os.path.join(topdir, path), files[path])
+        self._prune_by_hash(topdir, files)
+
+        fields = OrderedDict(self.extra_data)
+        for k in RELEASE_FIELDS:
+            if self.data.get(k) and k not in fields:
+                fields[k] = self.data[k]
+        fields['Date'] = formatdate(usegmt=True)[:-3] + 'UTC'
+        fields['Acquire-By-Hash'] = 'yes'
+
+        lines = ['%s: %s' % (k, v) for k, v in fields.items()]
+        for section, hash_name in RELEASE_HASHES.items():
+            lines.append(section + ':')
+            for path, info in files.items():
+                lines.append(' %s %16d %s' % (info[hash_name], info['size'], path))
+        content = '\n'.join(lines) + '\n'
+        with open(release_file, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        self.content = content
         from .sign import sign_file
         sign_file(topdir)
+        self._update_refs(release_file)
         return
 
+    @staticmethod
+    def _update_refs(release_file):
+        """
+        索引文件改变了，更新软件源的引用索引
+        """
+        archive_dir, sep, _ = os.path.abspath(release_file).rpartition('/dists/')
+        if not sep:
+            return
+        try:
+            refs = ref_index(archive_dir)
+            if refs is not None:
+                refs.update_release(Release.parse(release_file))
+                refs.close()
+        except sqlite3.Error as e:
+            logger.warning('failed to update file references: %s', e)
+
     def merge_data(self, other_data):
         """
         merge release data to current
@@ -248,79 +1363,83 @@ class Packages(object):
             self.arch = ''
         self.data = {}
 
-    def _read(self):
-        read_temp_data = read_url(self.filepath)
-        if self.filepath.endswith('.gz'):
-            self.filepath = self.filepath.rsplit('.', 1)[0]
-            try:
-                data = gzip.GzipFile(fileobj=BytesIO(read_temp_data)).read()
-            except:
-                data = read_temp_data
-        else:
-            data = read_temp_data
+    @staticmethod
+    def _stanza(text):
+        return Package(text)
 
-        if PY3:
-            return data.decode('utf-8')
+    @classmethod
+    def iter_stanzas(cls, packages_file, checksum=None, cache=True):
+        """
+        流式读取索引文件，逐条返回其中的记录，内存占用与文件大小无关。
+        checksum是Release中记录的校验值，用于查找解析结果的缓存；
+        cache为False时不读写缓存，用于马上就要改写的索引
+        """
+        if index_cache is None or not cache:
+            stanzas = (cls._stanza(section)
+                       for section in iter_sections(packages_file, checksum))
         else:
-            return data
+            stanzas = index_cache.iter_stanzas(packages_file, checksum)
+            if stanzas is None:
+                stanzas = index_cache.cached_stanzas(
+                    packages_file,
+                    (cls._stanza(section)
+                     for section in iter_sections(packages_file, checksum)),
+                    checksum)
+        for stanza in stanzas:
+            yield stanza
 
-    def _parse(self):
-        temp = self._read()
-        sections = temp.strip().split('\n\n')
-        for section in sections:
-            if not section.strip():
-                continue
-            package = Package(section)
-            # 同一个Packages里还有重复的，所以需要保留版本号最高的那个
+    @staticmethod
+    def _newer(package, old_version):
+        """
+        同一个Packages里还有重复的，所以需要保留版本号最高的那个
+        """
+        return package > old_version
+
+    @classmethod
+    def iter_latest(cls, packages_file, summary=None, checksum=None):
+        """
+        流式读取索引文件，同名记录只保留 parse 时会保留的那一条。
+        读完整个文件前只在内存中保存每条记录的 summary(记录) 结果，
+        返回这些结果；不提供 summary 时返回记录本身
+        """
+        latest = OrderedDict()
+        for package in cls.iter_stanzas(packages_file, checksum):
+            old = latest.get(package.name)
+            if old is None or cls._newer(package, old[0]):
+                latest[package.name] = (package.version,
+                                        summary(package) if summary else package)
+        for _, value in latest.values():
+            yield value
+
+    def _parse(self, checksum=None):
+        packages_file = self.filepath
+        self.filepath = index_path(packages_file)
+        for package in self.iter_stanzas(packages_file, checksum):
             old_version = self.data.get(package.name, '')
-            if package > old_version:
+            if self._newer(package, old_version):
                 self.data[package.name] = package
         return self.data
 
     @staticmethod
-    def parse(packages_file):
+    def parse(packages_file, checksum=None):
         obj = Packages(packages_file)
-        obj._parse()
+        obj._parse(checksum)
         return obj
 
-    @staticmethod
-    def zip_packages(packagesfile, content=None):
-        """
-        根据Packages生成Packages.gz
-        """
-        if not content:
-            with open(packagesfile, 'rb') as f:
-                content = f.read()
-        # gz
-        zfile = gzip.open(packagesfile + '.gz', mode='wb')
-        zfile.write(content)
-        zfile.close()
-        return
-
     def write(self, newpath=None, backup=''):
         """
-        包列表写入Packages，并生成Packages.gz
+        包列表写入Packages，并生成Packages.gz、Packages.xz
+        返回写入的各个文件的大小和校验值
         """
         filepath = newpath or self.filepath
         # create a origin backup
         if backup and os.path.exists(filepath):
             os.rename(filepath, filepath + '.' + backup)
-        # write new
-        if PY3:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                for pkg_name in sorted(self.data.keys()):
-                    f.write(str(self.data[pkg_name]) + '\n\n')
-        else:
-            with open(filepath, 'w') as f:
-                for pkg_name in sorted(self.data.keys()):
-                    f.write(str(self.data[pkg_name]) + '\n\n')
-        # remove compressed
-        for ext in ['.gz', '.bz2', '.xz']:
-            compressed_file = filepath + ext
-            if os.path.exists(compressed_file):
-                os.unlink(compressed_file)
-        self.zip_packages(filepath)
-        return
+        # write new, 同时生成压缩文件
+        with IndexWriter(filepath) as writer:
+            for pkg_name in sorted(self.data.keys()):
+                writer.write(str(self.data[pkg_name]) + '\n\n')
+        return writer.files
 
     def __setitem__(self, key, item):
         self.data[key] = item
@@ -392,9 +1511,20 @@ class Package(PY3__cmp__, object):
     def size(self):
         return int(self.data['Size'])
 
+    @property
+    def sha256(self):
+        return self.data.get('SHA256')
+
     def __str__(self):
         return self.text
 
+    def __getstate__(self):
+        # 用于索引缓存
+        return self.text, self.data
+
+    def __setstate__(self, state):
+        self.text, self.data = state
+
     def __cmp__(self, other):
         return Version(self.version).__cmp__(other)
 
@@ -427,24 +1557,23 @@ class Package(PY3__cmp__, object):
 
 class Sources(Packages):
 
-    def _parse(self):
-        temp = self._read()
-        sections = temp.strip().split('\n\n')
-        for section in sections:
-            if not section.strip():
-                continue
-            source = Source(section)
-            self.data[source.name] = source
-        return self.data
+    @staticmethod
+    def _stanza(text):
+        return Source(text)
+
+    @staticmethod
+    def _newer(source, old_version):
+        # 同名的源码包以后出现的为准
+        return True
 
     @property
     def version(self):
         return self.source_version
 
     @staticmethod
-    def parse(sources_file):
+    def parse(sources_file, checksum=None):
         obj = Sources(sources_file)
-        obj._parse()
+        obj._parse(checksum)
         return obj
 
 
@@ -469,11 +1598,76 @@ class Source(Package):
         directory = self.data['Directory']
         return [(md5, size, directory + '/' + filename) for md5, size, filename in self.data['files']]
 
+    @property
+    def sha256s(self):
+        """
+        Checksums-Sha256中的 {文件路径: sha256}
+        """
+        directory = self.data['Directory']
+        return dict((directory + '/' + filename, sha256) for sha256, _, filename
+                    in re.findall(sha256_files_pattern, self.text))
+
     @property
     def arch(self):
         return 'src'
 
 
+version_part_pattern = re.compile(r'([^0-9]*)([0-9]*)')
+# 每个版本号的排序键只计算一次
+_version_keys = {}
+
+
+def _char_order(c):
+    """
+    与dpkg一致的字符排序：~ 最小，字母在其他符号之前
+    """
+    if c == '~':
+        return -1
+    elif 'a' <= c <= 'z' or 'A' <= c <= 'Z':
+        return ord(c)
+    else:
+        return ord(c) + 256
+
+
+def _part_key(part):
+    """
+    上游版本号或debian修订号的排序键：
+    非数字段与数字段交替排列，非数字段逐字符比较并以0结尾，
+    最后以 (0,) 结尾，它排在 ~ 之后、其他字符之前，与dpkg中字符串结束的处理一致
+    """
+    key = []
+    for letters, digits in version_part_pattern.findall(part):
+        if not letters and not digits:
+            continue
+        key.append(tuple(_char_order(c) for c in letters) + (0,))
+        key.append(int(digits or 0))
+    if not key:
+        # 空字符串与 "0" 相等
+        key = [(0,), 0]
+    key.append((0,))
+    return tuple(key)
+
+
+def version_key(version):
+    """
+    把debian版本号转换为可以直接比较的元组，比较结果与 dpkg --compare-versions 一致
+    """
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    epoch, sep, rest = version.partition(':')
+    if not sep:
+        epoch, rest = '0', version
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = rest, ''
+    key = (int(epoch) if epoch.isdigit() else 0,
+           _part_key(upstream), _part_key(revision))
+    _version_keys[version] = key
+    return key
+
+
 class Version(PY3__cmp__, object):
     def __init__(self, value):
         self.version = value
@@ -481,13 +1675,16 @@ class Version(PY3__cmp__, object):
     def __repr__(self, *args, **kwargs):
         return self.version
 
+    @property
+    def key(self):
+        return version_key(self.version)
+
     def __cmp__(self, other):
-        import apt
         try:
             other_version = other.version
         except:
             other_version = str(other)
-        return apt.apt_pkg.version_compare(self.version, other_version)
+        return cmp(self.key, version_key(other_version))
 
 
 class Contents(object):
@@ -504,30 +1701,15 @@ class Contents(object):
         self.arch = arch or os.path.splitext(filepath)[0].split('-')[-1]
 
     @staticmethod
-    def parse(contents_file):
+    def parse(contents_file, checksum=None):
         obj = Contents(contents_file)
         obj._parse()
         return obj
 
-    def _read(self):
-        read_temp_data = read_url(self.filepath)
-        if self.filepath.endswith('.gz'):
-            self.filepath = self.filepath.rsplit('.', 1)[0]
-            try:
-                data = gzip.GzipFile(fileobj=BytesIO(read_temp_data)).read()
-            except:
-                data = read_temp_data
-        else:
-            data = read_temp_data
-
-        if PY3:
-            return data.decode('utf-8')
-        else:
-            return data
-
     def _parse(self):
-        temp = self._read()
-        for line in temp.split('\n'):
+        contents_file = self.filepath
+        self.filepath = index_path(contents_file)
+        for line in iter_lines(contents_file):
             if not line:
                 break
             self._parse_line(line)
@@ -551,25 +1733,12 @@ class Contents(object):
         # create a origin backup
         if backup and os.path.exists(filepath):
             os.rename(filepath, filepath + '.' + backup)
-        # write new
-        with open(filepath, 'w') as f:
+        # write new, 同时生成压缩文件
+        with IndexWriter(filepath, ('', '.gz')) as writer:
             for filename in sorted(self.files.keys()):
                 packages = self.files[filename]
-                f.write(filename + '\t' * 5 + ','.join(packages) + '\n')
-        self.zip_contents(filepath)
-
-    @staticmethod
-    def zip_contents(contents_file, content=None):
-        """
-        根据Contents生成Contents.gz
-        """
-        if not content:
-            with open(contents_file, 'rb') as f:
-                content = f.read()
-        # gz and bz2
-        zfile = gzip.open(contents_file + '.gz', mode='wb')
-        zfile.write(content)
-        zfile.close()
+                writer.write(filename + '\t' * 5 + ','.join(packages) + '\n')
+        return writer.files
 
     def remove_package(self, package):
         file_list = self.packages.pop(package)
@@ -601,60 +1770,74 @@ class ContentsInDB(object):
         filepath like [path-to]/Contents-[arch]
         """
         self.dbfile = tempfile.mktemp(suffix='.db')
-        self.db = sqlite3.connect(self.dbfile)
-        # self.db.text_factory = str
+        self._connect()
         self.filepath = filepath
         self.arch = arch or os.path.splitext(filepath)[0].split('-')[-1]
 
+    def _connect(self):
+        # 可能在线程池中解析
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        # self.db.text_factory = str
+        cu = self.db.cursor()
+        # 临时数据库，不需要日志和崩溃恢复
+        cu.execute('pragma journal_mode=off')
+        cu.execute('pragma synchronous=off')
+        # 64M 页缓存
+        cu.execute('pragma cache_size=-65536')
+        cu.execute('pragma temp_store=memory')
+
     def _create_table(self):
         cu = self.db.cursor()
         cu.execute('create table file (file ntext, package_name, package)')
         self.db.commit()
 
+    def _create_index(self):
+        """
+        数据导入完成后再建索引，比边插入边维护索引快得多
+        """
+        cu = self.db.cursor()
+        cu.execute('create index if not exists file_package_name on file (package_name)')
+        cu.execute('create index if not exists file_file on file (file)')
+        self.db.commit()
+
     @staticmethod
-    def parse(contents_file):
+    def parse(contents_file, checksum=None):
         obj = ContentsInDB(contents_file)
-        obj._parse()
+        obj._parse(checksum)
         return obj
 
-    def _read(self):
-        read_temp_data = read_url(self.filepath)
-        if self.filepath.endswith('.gz'):
-            self.filepath = self.filepath.rsplit('.', 1)[0]
-            try:
-                data = gzip.GzipFile(fileobj=BytesIO(read_temp_data)).read()
-            except:
-                data = read_temp_data
-        else:
-            data = read_temp_data
-
-        if PY3:
-            return data.decode('utf-8')
-        else:
-            return data
-
-    def _parse(self):
-        temp = self._read()
+    def _parse(self, checksum=None):
+        contents_file = self.filepath
+        self.filepath = index_path(contents_file)
+        if index_cache is not None:
+            self.db.close()
+            loaded = index_cache.load_file(contents_file, self.dbfile, checksum)
+            self._connect()
+            if loaded:
+                return
         self._create_table()
-        for line in temp.split('\n'):
-            if not line:
-                break
-            self._parse_line(line)
+        # 所有记录在一个事务中批量插入
+        cu = self.db.cursor()
+        cu.executemany('insert into file values (?,?,?)',
+                       self._parse_lines(iter_lines(contents_file, checksum)))
         self.db.commit()
+        self._create_index()
+        if index_cache is not None:
+            index_cache.store_file(contents_file, self.dbfile, checksum)
 
-    def _parse_line(self, line):
+    @staticmethod
+    def _parse_lines(lines):
         """
-        导入Contents文件中的一行数据
+        把Contents文件中的每一行转换成 (文件, 包名, 带section的包名) 记录
         """
-        filename, packages = line.rsplit(None, 1)
-        cu = self.db.cursor()
-        for package in packages.split(','):
-            package_name = package.split('/')[-1]
-            cu.execute("insert into file values (?,?,?)",
-                       (filename.decode('latin-1'),
-                        package_name,
-                        package
-                        ))
+        for line in lines:
+            if not line:
+                break
+            filename, packages = line.rsplit(None, 1)
+            if not PY3:
+                filename = filename.decode('latin-1')
+            for package in packages.split(','):
+                yield filename, package.split('/')[-1], package
 
     def write(self, newpath=None, backup=''):
         """
@@ -664,38 +1847,24 @@ class ContentsInDB(object):
         # create a origin backup
         if backup and os.path.exists(filepath):
             os.rename(filepath, filepath + '.' + backup)
-        # write new
-        with open(filepath, 'wb') as f:
+        # write new, 同时生成压缩文件
+        with IndexWriter(filepath, ('', '.gz')) as writer:
             cur = self.db.cursor()
             cur.execute('select * from file order by file')
-            last_file = ''
-            while 1:
-                row = cur.fetchone()
-                if not row:
-                    break
-                filename = row[0].encode('latin-1')
-                if filename != last_file:
-                    if last_file:
-                        f.write('\n')
-                    f.write(filename + '\t' * 5 + row[2].encode('latin-1'))
-                    last_file = filename
+            last_file = None
+            for row in cur:
+                if row[0] != last_file:
+                    line = ('\n' if last_file is not None else '') + \
+                        row[0] + '\t' * 5 + row[2]
+                    last_file = row[0]
                 else:
-                    f.write(',' + row[2])
-            f.write('\n')
-        self.zip_contents(filepath)
-
-    @staticmethod
-    def zip_contents(contents_file, content=None):
-        """
-        根据Contents生成Contents.gz
-        """
-        if not content:
-            with open(contents_file, 'rb') as f:
-                content = f.read()
-        # gz
-        zfile = gzip.open(contents_file + '.gz', mode='wb')
-        zfile.write(content)
-        zfile.close()
+                    line = ',' + row[2]
+                if not PY3:
+                    line = line.encode('latin-1')
+                writer.write(line)
+            if last_file is not None:
+                writer.write('\n')
+        return writer.files
 
     def remove_package(self, package):
         cur = self.db.cursor()
@@ -710,9 +1879,8 @@ class ContentsInDB(object):
     def add_package(self, package, file_list):
         package_name = package.split('/')[-1]
         cur = self.db.cursor()
-        for filename in file_list:
-            cur.execute('insert into file values (?,?,?)',
-                        (filename, package_name, package))
+        cur.executemany('insert into file values (?,?,?)',
+                        ((filename, package_name, package) for filename in file_list))
         self.db.commit()
 
     def files_of_package(self, package_name):
@@ -737,6 +1905,277 @@ def strip_packages(packagesfile):
     return
 
 
+# 每个线程的读缓冲区
+_hash_buffers = threading.local()
+# 批量计算校验值时报告进度的间隔（秒）
+HASH_PROGRESS_INTERVAL = 30
+
+
+def file_hashes(filepath, hash_names=INDEX_HASHES):
+    """
+    读一遍文件同时计算多种校验值，返回 {算法: 校验值}
+    每个线程复用同一个读缓冲区，不为每块数据新建bytes对象
+    """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    hashes = [(name, hashlib.new(name)) for name in hash_names]
+    with open(filepath, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            for _, h in hashes:
+                h.update(view[:size])
+    return dict((name, h.hexdigest()) for name, h in hashes)
+
+
+class HashCache(object):
+    """
+    文件校验值的持久缓存，以 (设备, inode, 大小, 修改时间ns) 为文件的特征，
+    特征没变的文件直接使用上次计算的结果
+    """
+    # 每写入多少条提交一次
+    COMMIT_SIZE = 1000
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = None
+        self.pending = 0
+
+    def _connect(self):
+        if self.db is None:
+            dirname = os.path.dirname(self.dbfile)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.db = sqlite3.connect(self.dbfile)
+            self.db.execute('create table if not exists hashes (dev integer, ino integer, '
+                            'size integer, mtime_ns integer, md5 text, sha1 text, sha256 text, '
+                            'primary key (dev, ino))')
+        return self.db
+
+    @staticmethod
+    def signature(st):
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+    def get(self, st, hash_names):
+        """
+        缓存的 {算法: 校验值}，文件变化过或者缺少某种校验值时返回None
+        """
+        dev, ino, size, mtime_ns = self.signature(st)
+        row = self._connect().execute(
+            'select size, mtime_ns, md5, sha1, sha256 from hashes where dev=? and ino=?',
+            (dev, ino)).fetchone()
+        if not row or (row[0], row[1]) != (size, mtime_ns):
+            return None
+        cached = dict(zip(('md5', 'sha1', 'sha256'), row[2:]))
+        if not all(cached.get(name) for name in hash_names):
+            return None
+        return dict((name, cached[name]) for name in hash_names)
+
+    def put(self, st, digests):
+        db = self._connect()
+        dev, ino, size, mtime_ns = self.signature(st)
+        row = db.execute('select size, mtime_ns, md5, sha1, sha256 from hashes '
+                         'where dev=? and ino=?', (dev, ino)).fetchone()
+        values = {}
+        if row and (row[0], row[1]) == (size, mtime_ns):
+            # 同一个文件，保留其他算法的结果
+            values = dict(zip(('md5', 'sha1', 'sha256'), row[2:]))
+        values.update(digests)
+        db.execute('insert or replace into hashes values (?, ?, ?, ?, ?, ?, ?)',
+                   (dev, ino, size, mtime_ns,
+                    values.get('md5'), values.get('sha1'), values.get('sha256')))
+        self.pending += 1
+        if self.pending >= self.COMMIT_SIZE:
+            self.commit()
+
+    def commit(self):
+        if self.db is not None and self.pending:
+            self.db.commit()
+            self.pending = 0
+
+
+hash_cache = HashCache(os.path.join(config.CACHEDIR, 'hashes.db')) if config.CACHEDIR else None
+
+
+class RefIndex(object):
+    """
+    软件源中每个文件被哪些系列的哪些索引文件引用，保存在sqlite中。
+    索引文件以Release中记录的md5（没有记录时用大小和修改时间）判断是否变化，
+    只有变化了的索引才重新读取
+    """
+
+    def __init__(self, topdir, dbfile):
+        self.topdir = topdir
+        self.dbfile = dbfile
+        dirname = os.path.dirname(dbfile)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('create table if not exists indexes '
+                        '(path text primary key, suite text, signature text)')
+        self.db.execute('create table if not exists refs (file text, idx text)')
+        self.db.execute('create index if not exists refs_file on refs (file)')
+        self.db.execute('create index if not exists refs_idx on refs (idx)')
+        self.db.commit()
+
+    def update_release(self, release):
+        """
+        更新一个系列中有变化的索引，删除Release中已经没有的索引
+        """
+        suite_dir = os.path.dirname(release.filepath)
+        suite = os.path.relpath(suite_dir, os.path.join(self.topdir, 'dists'))
+        seen = set()
+        updated = 0
+        for name, index_class in (('Packages', Packages), ('Sources', Sources)):
+            for fn, fpath in release.index_files(name):
+                path = os.path.relpath(os.path.join(suite_dir, fn), self.topdir)
+                seen.add(path)
+                checksum = release.index_checksum(fpath)
+                if checksum:
+                    signature = checksum
+                else:
+                    st = os.stat(fpath)
+                    signature = '%d-%d' % (st.st_size, st.st_mtime)
+                row = self.db.execute('select signature from indexes where path=?',
+                                      (path,)).fetchone()
+                if row and row[0] == signature:
+                    continue
+                files = set()
+                for package in index_class.iter_latest(fpath, checksum=checksum):
+                    if isinstance(package, Source):
+                        files.update(package.files)
+                    else:
+                        files.add(package.filename)
+                self.db.execute('delete from refs where idx=?', (path,))
+                self.db.executemany('insert into refs values (?, ?)',
+                                    ((filename, path) for filename in files))
+                self.db.execute('insert or replace into indexes values (?, ?, ?)',
+                                (path, suite, signature))
+                updated += 1
+        for path, in self.db.execute('select path from indexes where suite=?',
+                                     (suite,)).fetchall():
+            if path not in seen:
+                self._drop(path)
+        self.db.commit()
+        if updated:
+            logger.debug('Updated references of %d index files in %s', updated, suite)
+
+    def _drop(self, path):
+        self.db.execute('delete from refs where idx=?', (path,))
+        self.db.execute('delete from indexes where path=?', (path,))
+
+    def sync(self):
+        """
+        按dists下所有的Release更新，删除已经不存在的系列
+        """
+        suites = set()
+        for release_file in glob.glob(os.path.join(self.topdir, 'dists', '*', 'Release')):
+            release = Release.parse(release_file)
+            self.update_release(release)
+            suites.add(os.path.basename(os.path.dirname(release_file)))
+        for path, suite in self.db.execute('select path, suite from indexes').fetchall():
+            if suite not in suites:
+                self._drop(path)
+        self.db.commit()
+
+    def referenced(self):
+        """
+        被索引引用的所有文件，路径相对于软件源目录
+        """
+        return set(path for path, in self.db.execute('select distinct file from refs'))
+
+    def users(self, filename):
+        """
+        引用文件的 [(系列, 索引文件), ...]，filename为相对于软件源目录的路径
+        """
+        return self.db.execute('select indexes.suite, refs.idx from refs join indexes '
+                               'on refs.idx = indexes.path where refs.file=? '
+                               'order by refs.idx', (filename,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def ref_index(topdir):
+    """
+    软件源的引用索引，配置的cachedir为空时返回None
+    """
+    if not config.CACHEDIR:
+        return None
+    return RefIndex(topdir, os.path.join(config.CACHEDIR, 'refs', hashlib.sha1(
+        topdir.encode('utf-8')).hexdigest() + '.db'))
+
+
+def _hash_file(args):
+    filepath, hash_names = args
+    try:
+        st = os.stat(filepath)
+        return filepath, st, file_hashes(filepath, hash_names)
+    except (IOError, OSError) as e:
+        logger.error('read failed: %s: %s', filepath, e)
+        return filepath, None, None
+
+
+def hash_files(filepaths, hash_names=('md5', 'sha256'), threads=None, cache=None,
+               refresh=False):
+    """
+    用线程池并发计算多个文件的校验值（hashlib计算时会释放GIL），
+    按完成的顺序生成 (路径, {算法: 校验值})，读取失败时校验值为None。
+    cache为HashCache时，没有变化的文件直接用缓存的结果，refresh为真时全部重新计算并更新缓存。
+    定期和结束时输出已读取的数据量和速度
+    """
+    todo = []
+    cached = 0
+    for filepath in filepaths:
+        digests = None
+        if cache is not None and not refresh:
+            try:
+                digests = cache.get(os.stat(filepath), hash_names)
+            except OSError:
+                pass
+        if digests is None:
+            todo.append(filepath)
+        else:
+            cached += 1
+            yield filepath, digests
+    if cached:
+        logger.info('%d files unchanged since last hashed', cached)
+
+    threads = threads or config.WORKERS or multiprocessing.cpu_count()
+    pool = multiprocessing.pool.ThreadPool(max(1, min(threads, len(todo))))
+    start = last_report = time.time()
+    total = 0
+    count = 0
+    try:
+        for filepath, st, digests in pool.imap_unordered(
+                _hash_file, [(filepath, hash_names) for filepath in todo]):
+            count += 1
+            if digests is not None:
+                total += st.st_size
+                if cache is not None:
+                    cache.put(st, digests)
+            now = time.time()
+            if now - last_report >= HASH_PROGRESS_INTERVAL:
+                last_report = now
+                logger.info('Hashed %d/%d files, %.1f MB/s', count, len(todo),
+                            total / 1048576.0 / (now - start))
+            yield filepath, digests
+    finally:
+        pool.terminate()
+        pool.join()
+        if cache is not None:
+            cache.commit()
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Hashed %d files, %.1f MB in %.1fs, %.1f MB/s', count, total / 1048576.0,
+                elapsed, total / 1048576.0 / elapsed)
+
+
 def file_hash(filepath, hash_name='md5'):
     import hashlib
     h = hashlib.new(hash_name)
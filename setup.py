@@ -41,10 +41,12 @@ setuptools.setup(
             'diff = apt_archive_tools.lib.diff:main',
             'check = apt_archive_tools.lib.check:main',
             'checkdep = apt_archive_tools.lib.checkdep:main',
-            'rename = apt_archive_tools.lib.rename:main'
+            'rename = apt_archive_tools.lib.rename:main',
+            'normalize = apt_archive_tools.lib.normalize:main'
         ]
     },
     install_requires=[
        "requests",
+       'scandir; python_version < "3.5"',
     ],
 )
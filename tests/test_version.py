@@ -0,0 +1,103 @@
+# coding:utf-8
+
+'''
+utils.version_key 与 dpkg 版本比较规则的一致性测试
+'''
+
+import random
+import subprocess
+
+import pytest
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from apt_archive_tools.lib import utils
+
+# (较小或相等的版本, 另一个版本, 比较结果)
+CASES = [
+    # ~ 比结尾还小
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~~a', '1.0~', -1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    # 字母比结尾大，比其他符号小
+    ('1.0', '1.0a', -1),
+    ('1.0a', '1.0b', -1),
+    ('1.0a', '1.0+', -1),
+    ('1.0+', '1.0.', -1),
+    ('1.0-1', '1.0-1+b1', -1),
+    # 数字按数值比较
+    ('2.0', '10.0', -1),
+    ('1.0', '1.00', 0),
+    ('1.01', '1.1', 0),
+    # epoch优先
+    ('2.0', '1:0.1', -1),
+    ('0:1.0', '1.0', 0),
+    ('1:1.0', '1:1.0-1', -1),
+    # 没有修订号与修订号为0相同
+    ('1.0', '1.0-0', 0),
+    ('1.0', '1.0-1', -1),
+    # 修订号从最后一个-开始
+    ('1.0-2-1', '1.0-10-1', -1),
+    ('1.0-a-1', '1.0-a-2', -1),
+]
+
+
+def _cmp(a, b):
+    ka, kb = utils.version_key(a), utils.version_key(b)
+    return (ka > kb) - (ka < kb)
+
+
+@pytest.mark.parametrize('a, b, expected', CASES)
+def test_version_key(a, b, expected):
+    assert _cmp(a, b) == expected
+    assert _cmp(b, a) == -expected
+
+
+@pytest.mark.parametrize('a, b, expected', CASES)
+def test_version_compare(a, b, expected):
+    if expected < 0:
+        assert utils.Version(a) < utils.Version(b)
+    elif expected == 0:
+        assert utils.Version(a) == utils.Version(b)
+
+
+def _random_versions(count, seed=20261017):
+    rnd = random.Random(seed)
+    parts = ['0', '1', '2', '9', '10', '01', '~', '~~', '+', '.', 'a', 'b', 'z', 'A', 'rc']
+    versions = set(a for a, _, _ in CASES) | set(b for _, b, _ in CASES)
+    while len(versions) < count:
+        upstream = str(rnd.randint(0, 3)) + ''.join(rnd.choice(parts)
+                                                    for _ in range(rnd.randint(0, 4)))
+        version = upstream
+        if rnd.random() < 0.3:
+            version = '%d:%s' % (rnd.randint(0, 2), version)
+        if rnd.random() < 0.5:
+            version += '-' + ''.join(rnd.choice(parts) for _ in range(rnd.randint(1, 3)))
+        versions.add(version)
+    return sorted(versions)
+
+
+def _dpkg_lt(a, b):
+    return subprocess.call(['dpkg', '--compare-versions', a, 'lt', b]) == 0
+
+
+@pytest.mark.skipif(not which('dpkg'), reason='dpkg not found')
+@pytest.mark.parametrize('a, b, expected', CASES)
+def test_cases_like_dpkg(a, b, expected):
+    op = {-1: 'lt', 0: 'eq', 1: 'gt'}[expected]
+    assert subprocess.call(['dpkg', '--compare-versions', a, op, b]) == 0
+
+
+@pytest.mark.skipif(not which('dpkg'), reason='dpkg not found')
+def test_sort_like_dpkg():
+    # 按version_key排序后，相邻的版本用dpkg比较，排序结果应该一致
+    versions = sorted(_random_versions(300), key=utils.version_key)
+    for a, b in zip(versions, versions[1:]):
+        if utils.version_key(a) == utils.version_key(b):
+            assert not _dpkg_lt(a, b) and not _dpkg_lt(b, a), (a, b)
+        else:
+            assert _dpkg_lt(a, b), (a, b)